@@ -0,0 +1,263 @@
+""" Benchmarks for the webstore client, run against the stand-in server
+in ``server.py`` so that no webstore installation is needed.
+
+Each benchmark is run a few times on fresh data and the best and
+median times are reported, together with the throughput in rows or
+requests per second. Results can be written to a JSON file and compared
+with those of an earlier run::
+
+    python bench/run.py --output before.json
+    # ... change the client ...
+    python bench/run.py --compare before.json
+
+With ``--compare``, the exit status is 1 if any benchmark got slower by
+more than ``--threshold`` percent, so the suite can guard a release.
+Use ``--latency`` to add an artificial delay to every request, which
+makes the effect of round trips visible on a local machine.
+"""
+import os
+import sys
+import csv
+import random
+import tempfile
+from time import time
+from threading import Thread
+from optparse import OptionParser
+try:
+    from json import dump, load
+except ImportError:
+    from simplejson import dump, load
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from webstore.client import Database, SocketTransport, WSGITransport
+
+import server as standin
+
+BENCHMARKS = []
+
+
+def benchmark(name, unit, transport=None):
+    """ Register a benchmark. The function is called with a fresh
+    ``Database`` and the options, and returns the number of `unit`
+    processed. A `setup` function may be attached to prepare data
+    outside of the timed part. `transport` selects the 'socket' or 
+    'wsgi' transport instead of the default connection pool. """
+    def _register(func):
+        BENCHMARKS.append((name, unit, transport, func))
+        return func
+    return _register
+
+
+def _rows(count, seed=42):
+    """ Generate `count` rows of reproducible data. """
+    rnd = random.Random(seed)
+    for i in xrange(count):
+        yield {'id': i, 'place': 'Town%d' % rnd.randint(0, 1000),
+               'temp': round(rnd.uniform(-30, 40), 2),
+               'humidity': round(rnd.random(), 3),
+               'note': 'x' * rnd.randint(0, 40)}
+
+
+def _fill(database, rows):
+    database['data'].writerows(_rows(rows), chunk_rows=5000)
+
+
+def _traverse(step, **kwargs):
+    def _run(database, options):
+        return len(list(database['data'].traverse(_step=step, **kwargs)))
+    _run.setup = lambda database, options: _fill(database, options.rows)
+    return _run
+
+
+for _step in (100, 1000, 10000):
+    benchmark('traverse step=%d' % _step, 'rows')(_traverse(_step))
+benchmark('traverse step=1000 prefetch=4', 'rows')(
+    _traverse(1000, _prefetch=4))
+benchmark('traverse step=1000 stream', 'rows')(
+    _traverse(1000, _stream=True))
+benchmark('traverse step=1000 keyset', 'rows')(
+    _traverse(1000, _keyset='__id__'))
+benchmark('traverse step=1000 wsgi', 'rows', 'wsgi')(_traverse(1000))
+benchmark('traverse adaptive', 'rows')(_traverse(100, _adaptive=True))
+
+
+def _writerows(chunk_rows, workers=1):
+    def _run(database, options):
+        database['data'].writerows(_rows(options.rows), chunk_rows=chunk_rows,
+                                   workers=workers)
+        return options.rows
+    return _run
+
+
+for _chunk in (100, 1000, 10000):
+    benchmark('writerows chunk=%d' % _chunk, 'rows')(_writerows(_chunk))
+benchmark('writerows chunk=1000 workers=4', 'rows')(_writerows(1000, 4))
+
+
+@benchmark('writerows stream', 'rows')
+def _writerows_stream(database, options):
+    database['data'].writerows(_rows(options.rows), stream=True)
+    return options.rows
+
+
+@benchmark('load_file csv', 'rows')
+def _load_file(database, options):
+    return database['data'].load_file(_load_file.path, chunk_rows=5000,
+                                      types={'id': int, 'temp': float})
+
+
+def _write_csv(database, options):
+    _load_file.path = os.path.join(tempfile.gettempdir(), 'bench.csv')
+    with open(_load_file.path, 'wb') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['id', 'place', 'temp', 'humidity', 'note'])
+        for row in _rows(options.rows):
+            writer.writerow([row['id'], row['place'], row['temp'],
+                             row['humidity'], row['note']])
+_load_file.setup = _write_csv
+
+
+@benchmark('writerow bufferlen=500', 'rows')
+def _buffered(database, options):
+    table = database['data']
+    for row in _rows(options.rows):
+        table.writerow(row, bufferlen=500)
+    table.flush()
+    return options.rows
+
+
+@benchmark('writerow background writer', 'rows')
+def _background(database, options):
+    with database['data'].start_writer(bufferlen=500) as table:
+        for row in _rows(options.rows):
+            table.writerow(row)
+    return options.rows
+
+
+@benchmark('query', 'requests')
+def _query(database, options):
+    for i in xrange(options.requests):
+        database.query('SELECT * FROM "data" WHERE "id" = ?', [i])
+    return options.requests
+_query.setup = lambda database, options: _fill(database, 1000)
+benchmark('query socket', 'requests', 'socket')(_query)
+benchmark('query wsgi', 'requests', 'wsgi')(_query)
+
+
+@benchmark('query_many concurrency=8', 'requests')
+def _query_many(database, options):
+    queries = [('SELECT * FROM "data" WHERE "id" = ?', [i])
+               for i in xrange(options.requests)]
+    return len(database.query_many(queries, concurrency=8))
+_query_many.setup = _query.setup
+
+
+@benchmark('concurrent clients=8 traverse', 'rows')
+def _clients(database, options):
+    counts = []
+
+    def _client():
+        handle = Database(database.server, database.database_user,
+                          database.database_name, port=database.port)
+        counts.append(len(list(handle['data'].traverse(_step=1000))))
+    threads = [Thread(target=_client) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
+_clients.setup = lambda database, options: _fill(database, options.rows / 8)
+
+
+def _transport(server, transport):
+    if transport == 'socket':
+        return SocketTransport('localhost', server.server_port)
+    if transport == 'wsgi':
+        return WSGITransport(server.application)
+
+
+def run(options, server):
+    """ Run all benchmarks matching the options, returning a dict of
+    results keyed by benchmark name. """
+    results = {}
+    for index, (name, unit, transport, func) in enumerate(BENCHMARKS):
+        if options.only and options.only not in name:
+            continue
+        times = []
+        for repeat in range(options.repeat):
+            database = Database('localhost', 'bench',
+                                'db%d_%d' % (index, repeat),
+                                port=server.server_port,
+                                transport=_transport(server, transport))
+            setup = getattr(func, 'setup', None)
+            if setup is not None:
+                setup(database, options)
+            started = time()
+            count = func(database, options)
+            times.append(time() - started)
+            database.transport.close()
+        times.sort()
+        results[name] = {'unit': unit, 'count': count, 'best': times[0],
+                         'median': times[len(times) / 2],
+                         'rate': count / times[0]}
+        print '%-36s %9.4fs %9.4fs %12.0f %s/s' % (name, times[0],
+            times[len(times) / 2], count / times[0], unit)
+        sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Print the change of each result against the baseline and
+    return the names of the benchmarks that got slower than
+    `threshold` percent. """
+    slower = []
+    print
+    print '%-36s %10s %10s %8s' % ('benchmark', 'before', 'after', 'change')
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['best'], results[name]['best']
+        change = (after - before) / before * 100
+        flag = ''
+        if change > threshold:
+            slower.append(name)
+            flag = ' SLOWER'
+        print '%-36s %9.4fs %9.4fs %+7.1f%%%s' % (name, before, after,
+                                                  change, flag)
+    return slower
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--rows', type='int', default=20000,
+                      help='rows per read/write benchmark')
+    parser.add_option('--requests', type='int', default=500,
+                      help='requests per query benchmark')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs per benchmark, the best one counts')
+    parser.add_option('--latency', type='float', default=0,
+                      help='artificial per-request latency in ms')
+    parser.add_option('--only', help='only run benchmarks containing this')
+    parser.add_option('--output', help='write results to this JSON file')
+    parser.add_option('--compare', help='compare with this JSON file')
+    parser.add_option('--threshold', type='float', default=10,
+                      help='slowdown in percent reported as a regression')
+    options, args = parser.parse_args()
+    server = standin.serve_in_thread(latency=options.latency / 1000.0)
+    print '%-36s %10s %10s %16s' % ('benchmark', 'best', 'median', 'rate')
+    results = run(options, server)
+    server.shutdown()
+    if options.output:
+        with open(options.output, 'w') as fh:
+            dump({'options': vars(options), 'results': results}, fh,
+                 indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as fh:
+            baseline = load(fh)['results']
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+""" A small stand-in for the webstore server, backed by in-memory
+sqlite databases. It speaks the subset of the webstore HTTP API that
+the client uses (table listing, traversal with filters, sorting and
+paging, row writes with ``unique`` columns, SQL queries, schema,
+distinct and delete) so that the client can be measured without the
+real ``webstore.web`` application. ``Application`` is the same server
+as a WSGI application, for use with an in-process transport.
+
+Run it stand-alone with::
+
+    python bench/server.py --port 6675 --latency 2
+"""
+import re
+import sys
+import socket
+import zlib
+import gzip
+import sqlite3
+import threading
+from time import sleep
+from hashlib import md5
+from StringIO import StringIO
+from urlparse import urlparse, parse_qsl
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from httplib import responses as RESPONSES
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+try:
+    from json import loads, dumps
+except ImportError:
+    from simplejson import loads, dumps
+
+NAME_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9_]*$')
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class StoreError(Exception):
+
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+
+
+class Store(object):
+    """ A set of in-memory sqlite databases, keyed by user and
+    database name. """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.databases = {}
+
+    def connection(self, user, database):
+        key = (user, database)
+        with self.lock:
+            if key not in self.databases:
+                conn = sqlite3.connect(':memory:', check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+                self.databases[key] = conn
+            return self.databases[key]
+
+    def tables(self, conn):
+        cur = conn.execute("SELECT name FROM sqlite_master "
+                           "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+        return [r[0] for r in cur]
+
+    def columns(self, conn, table):
+        cur = conn.execute("PRAGMA table_info(%s)" % _quote(table))
+        return [r[1] for r in cur]
+
+    def check_table(self, conn, table):
+        if table not in self.tables(conn):
+            raise StoreError(404, 'No such table: %s' % table)
+
+    def traverse(self, conn, table, params):
+        self.check_table(conn, table)
+        columns = self.columns(conn, table)
+        where, args, order = [], [], []
+        limit, offset = None, 0
+        for key, value in params:
+            if key == '_limit':
+                limit = int(value)
+            elif key == '_offset':
+                offset = int(value)
+            elif key == '_sort':
+                direction, column = value.split(':', 1)
+                if column not in columns or \
+                        direction.lower() not in ('asc', 'desc'):
+                    raise StoreError(400, 'Invalid sort: %s' % value)
+                order.append('%s %s' % (_quote(column), direction.upper()))
+            elif key.startswith('_'):
+                continue
+            elif key in columns:
+                where.append('%s = ?' % _quote(key))
+                args.append(value.decode('utf-8'))
+            else:
+                raise StoreError(400, 'No such column: %s' % key)
+        sql = 'SELECT * FROM %s' % _quote(table)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + ', '.join(order or ['"__id__" ASC'])
+        sql += ' LIMIT %d OFFSET %d' % (-1 if limit is None else limit,
+                                        offset)
+        return self.query(conn, sql, args)
+
+    def query(self, conn, sql, params=None):
+        with self.lock:
+            try:
+                cur = conn.execute(sql, params or [])
+            except sqlite3.Error, e:
+                raise StoreError(400, unicode(e))
+            if cur.description is None:
+                conn.commit()
+                return {'state': 'success', 'message': 'Query executed.',
+                        'url': None}
+            keys = [d[0] for d in cur.description]
+            return {'keys': keys, 'data': [dict(zip(keys, r)) for r in cur]}
+
+    def write(self, conn, table, rows, unique):
+        if not NAME_RE.match(table):
+            raise StoreError(400, 'Invalid table name: %s' % table)
+        if isinstance(rows, dict):
+            rows = [rows]
+        with self.lock:
+            try:
+                self._write(conn, table, rows, unique)
+                conn.commit()
+            except sqlite3.Error, e:
+                conn.rollback()
+                raise StoreError(400, unicode(e))
+
+    def _write(self, conn, table, rows, unique):
+        if table not in self.tables(conn):
+            conn.execute('CREATE TABLE %s ("__id__" INTEGER PRIMARY KEY '
+                         'AUTOINCREMENT)' % _quote(table))
+        columns = set(self.columns(conn, table))
+        for row in rows:
+            for column in row.keys():
+                if column not in columns:
+                    conn.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                        _quote(table), _quote(column)))
+                    columns.add(column)
+            updated = 0
+            if unique:
+                sets = [c for c in row.keys() if c != '__id__']
+                sql = 'UPDATE %s SET %s WHERE %s' % (
+                    _quote(table),
+                    ', '.join('%s = ?' % _quote(c) for c in sets),
+                    ' AND '.join('%s = ?' % _quote(c) for c in unique))
+                args = [row[c] for c in sets] + [row.get(c) for c in unique]
+                updated = conn.execute(sql, args).rowcount
+            if not updated:
+                keys = row.keys()
+                sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                    _quote(table), ', '.join(map(_quote, keys)),
+                    ', '.join('?' * len(keys)))
+                conn.execute(sql, [row[k] for k in keys])
+
+    def delete(self, conn, table):
+        with self.lock:
+            self.check_table(conn, table)
+            conn.execute('DROP TABLE %s' % _quote(table))
+            conn.commit()
+
+
+class Application(object):
+    """ The stand-in server as a WSGI application, so that it can also
+    be called in-process. """
+
+    def __init__(self, store=None, latency=0):
+        self.store = store or Store()
+        self.latency = latency
+
+    def __call__(self, environ, start_response):
+        headers = dict((k[5:].replace('_', '-').title(), v) for k, v
+                       in environ.items() if k.startswith('HTTP_'))
+        for key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            if environ.get(key):
+                headers[key.replace('_', '-').title()] = environ[key]
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length) if length else ''
+        path = environ.get('PATH_INFO', '')
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        status, headers, body = self.respond(environ['REQUEST_METHOD'],
+                                             path, headers, body)
+        start_response('%d %s' % (status, RESPONSES.get(status, '')),
+                       headers + [('Content-Length', str(len(body)))])
+        return [body]
+
+    def respond(self, method, path, headers, body):
+        """ Handle a request, returning a tuple of (status, headers,
+        body). """
+        if self.latency:
+            sleep(self.latency)
+        encoding = headers.get('Content-Encoding', '').lower()
+        if encoding == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        url = urlparse(path)
+        try:
+            status, data, cacheable = self._dispatch(method, url, body)
+        except StoreError, se:
+            status, data, cacheable = se.status, {'state': 'error',
+                'message': se.message, 'url': url.path}, False
+        except ValueError, ve:
+            status, data, cacheable = 400, {'state': 'error',
+                'message': unicode(ve), 'url': url.path}, False
+        return self._encode(headers, status, data, cacheable)
+
+    def _dispatch(self, method, url, body):
+        store = self.store
+        parts = [p for p in url.path.split('/') if p]
+        params = parse_qsl(url.query, keep_blank_values=True)
+        if len(parts) < 2:
+            raise StoreError(404, 'Not found: %s' % url.path)
+        conn = store.connection(parts[0], parts[1])
+        if len(parts) == 2:
+            if method == 'GET':
+                names = store.tables(conn)
+                return 200, {'data': [{'name': n} for n in names]}, True
+            if method == 'PUT':
+                payload = loads(body)
+                return 200, store.query(conn, payload.get('query'),
+                                        payload.get('params')), False
+        table = parts[2]
+        if len(parts) == 3:
+            if method == 'GET':
+                return 200, store.traverse(conn, table, params), True
+            if method == 'POST':
+                unique = [v for k, v in params if k == 'unique']
+                store.write(conn, table, loads(body), unique)
+                return 201, {'state': 'success',
+                    'message': 'Table updated: %s' % table,
+                    'url': url.path}, False
+            if method == 'DELETE':
+                store.delete(conn, table)
+                return 410, {'state': 'success',
+                    'message': 'Table dropped: %s' % table,
+                    'url': url.path}, False
+        if method == 'GET' and parts[3] == 'schema':
+            store.check_table(conn, table)
+            return 200, {'data': [{'name': c} for c in
+                store.columns(conn, table)]}, True
+        if method == 'GET' and parts[3] == 'distinct' and len(parts) > 4:
+            store.check_table(conn, table)
+            return 200, store.query(conn, 'SELECT DISTINCT %s FROM %s' % (
+                _quote(parts[4]), _quote(table))), True
+        raise StoreError(405, 'Method not allowed: %s' % method)
+
+    def _encode(self, request_headers, status, data, cacheable):
+        body = dumps(data)
+        headers = [('Content-Type', 'application/json')]
+        if cacheable:
+            etag = '"%s"' % md5(body).hexdigest()
+            headers.append(('ETag', etag))
+            if request_headers.get('If-None-Match') == etag:
+                status, body = 304, ''
+        accept = request_headers.get('Accept-Encoding', '')
+        if body and 'gzip' in accept:
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            headers.append(('Content-Encoding', 'gzip'))
+        elif body and 'deflate' in accept:
+            body = zlib.compress(body)
+            headers.append(('Content-Encoding', 'deflate'))
+        return status, headers, body
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP,
+                                   socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            return ''.join(parts)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _dispatch(self, method):
+        status, headers, body = self.server.application.respond(method,
+            self.path, self.headers, self._read_body())
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0, application=None):
+        HTTPServer.__init__(self, address, Handler)
+        self.application = application or Application(latency=latency)
+
+
+def serve_in_thread(host='localhost', port=0, latency=0):
+    """ Start a stand-in server on a background thread and return it.
+    With ``port=0`` a free port is picked, see ``server.server_port``.
+    """
+    server = StandInServer((host, port), latency=latency)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='standin-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='localhost')
+    parser.add_option('--port', type='int', default=6675)
+    parser.add_option('--latency', type='float', default=0,
+                      help='artificial per-request latency in ms')
+    options, args = parser.parse_args()
+    server = StandInServer((options.host, options.port),
+                           latency=options.latency / 1000.0)
+    print >>sys.stderr, 'Serving on %s:%s' % (options.host, options.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,18 @@
 import sys
+import zlib
+import socket
 import unittest
 import tempfile
+from StringIO import StringIO
+from json import loads, dumps
 
 from webstore.client import Database, Table, WebstoreClientException
+from webstore.client import ResponseCache, RetryPolicy, ClientStats, Row
+from webstore.client import PageSizer, RawJSON, get_codec, col
+from webstore.client import ShardedTable
+from webstore.client import SocketTransport, WSGITransport, ConnectionPool
+from webstore.client import _stream_array, JSONDecoder
+from webstore.client.asynchronous import AsyncDatabase
 
 from threading import Thread
 try:
@@ -20,7 +30,7 @@ def run_webstore():
 server = Thread(target=run_webstore, name='server')
 server.daemon = True
 server.start()
-from time import sleep
+from time import sleep, time
 sleep(1)
 
 FIXTURES = [{'place': 'Berlin', 'temp': '5', 'humidity': '0.6'},
@@ -54,10 +64,145 @@ class WebstoreClientTestCase(unittest.TestCase):
         assert 'test' in self.database, self.database.tables()
         assert 'foo' not in self.database, self.database.tables()
     
+    def test_database_transports(self):
+        for transport in (SocketTransport(self.server_url, self.port),
+                          WSGITransport(app)):
+            database = Database(self.server_url, 'test', 'test',
+                                port=self.port, transport=transport)
+            table = database['test']
+            assert table.transport is transport, table.transport
+            assert len(list(table.traverse(_step=2)))==len(FIXTURES)
+            table.writerows(({'place': 'Town%s' % i} for i in range(3)),
+                            stream=True)
+            assert len(list(table))==len(FIXTURES)+3
+            table.delete()
+            table.writerows(FIXTURES)
+
+    def test_database_catalog(self):
+        database = Database(self.server_url, 'test', 'test',
+                port=self.port, catalog_ttl=60)
+        assert 'test' in database, database.tables()
+        assert 'foo' not in database, database.tables()
+        database['foo'].writerow({'place': 'Tokyo'})
+        assert 'foo' in database, database.tables()
+        database['foo'].delete()
+        assert 'foo' not in database, database.tables()
+        self.table.delete()
+        assert 'test' in database
+        assert 'test' not in database.tables(refresh=True)
+        database.tables = None
+        assert 'test' not in database
+        # a table created while the list is fetched is kept.
+        database.hooks['before_request'].append(
+            lambda *args: database._catalog_update('bar', True))
+        database._fetch_catalog(refresh=True)
+        assert 'bar' in database, database._catalog
+
+    def test_database_query_many(self):
+        queries = ['SELECT COUNT(*) AS n FROM test',
+                   ('SELECT * FROM test WHERE place = ?', ['Berlin']),
+                   'SELECT * FROM nosuchtable']
+        results = self.database.query_many(queries, concurrency=2)
+        assert results[0]['data'][0]['n']==len(FIXTURES), results
+        assert results[1]['data'][0]['place']=='Berlin', results
+        assert isinstance(results[2], WebstoreClientException), results
+        streamed = dict(self.database.query_many(queries, stream=True))
+        assert sorted(streamed.keys())==[0, 1, 2], streamed
+
+    def test_pool_stale_connection(self):
+        from httplib import BadStatusLine
+        class Stale(object):
+            def __init__(self, fail_send):
+                # an idle socket: the server drops the connection only
+                # after the pool has checked it.
+                self.sock, self.peer = socket.socketpair()
+                self.fail_send = fail_send
+            def request(self, *args):
+                if self.fail_send:
+                    raise socket.error('Broken pipe')
+            def getresponse(self):
+                raise BadStatusLine('')
+            def close(self):
+                pass
+        pool = self.database.pool
+        def stale(fail_send=False):
+            pool._idle.append((Stale(fail_send), time()))
+        stale()
+        assert len(list(self.table))==len(FIXTURES)
+        stale()
+        self.assertRaises(BadStatusLine, self.table.writerow,
+                          {'place': 'Oslo'})
+        stale()
+        self.table.writerow({'place': 'Oslo'}, unique_columns=['place'])
+        stale(fail_send=True)
+        self.table.writerow({'place': 'Rome'})
+        assert len(list(self.table))==len(FIXTURES)+2
+
+    def test_pool_dropped_connection(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('localhost', 0))
+        listener.listen(5)
+        def serve():
+            # answers one request per connection, then closes it
+            # although the response allows keep-alive.
+            while True:
+                conn, addr = listener.accept()
+                conn.recv(65536)
+                conn.sendall('HTTP/1.1 200 OK\r\n'
+                             'Content-Length: 2\r\n\r\nok')
+                conn.close()
+        thread = Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        pool = ConnectionPool('localhost', listener.getsockname()[1])
+        for i in range(3):
+            response = pool.request('PUT', '/', 'x', {'Content-Length': 1})
+            assert response.read()=='ok'
+            assert len(pool._idle)==1, pool._idle
+            sleep(0.1)
+
     def test_database_getitem(self):
         test = self.database['test']
         assert isinstance(test, Table), test
 
+    def test_database_table_share_pool(self):
+        assert self.table.pool is self.database.pool, self.table.pool
+        list(self.table)
+        list(self.table)
+        assert len(self.database.pool._idle)==1, self.database.pool._idle
+
+    def test_compression(self):
+        def compressing_app(environ, start_response):
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = environ['wsgi.input'].read(length)
+            if body:
+                encodings.append(environ.get('HTTP_CONTENT_ENCODING'))
+                received.extend(loads(zlib.decompress(body,
+                                                      16 + zlib.MAX_WBITS)))
+            data = dumps({'data': FIXTURES})
+            if encoding == 'gzip':
+                gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                data = gz.compress(data) + gz.flush()
+            else:
+                data = zlib.compress(data)
+            start_response('200 OK', [('Content-Type', 'application/json'),
+                                      ('Content-Encoding', encoding),
+                                      ('Content-Length', str(len(data)))])
+            return [data]
+        for encoding in ('gzip', 'deflate'):
+            encodings, received = [], []
+            database = Database(self.server_url, 'test', 'test',
+                                transport=WSGITransport(compressing_app),
+                                compress_threshold=0)
+            table = database['test']
+            assert list(table.traverse(_step=10))==FIXTURES, encoding
+            streamed = list(table.traverse(_step=10, _stream=True))
+            assert streamed==FIXTURES, encoding
+            table.writerows(FIXTURES)
+            table.writerows(iter(FIXTURES), stream=True)
+            assert received==FIXTURES*2, received
+            assert encodings==['gzip', 'gzip'], encodings
+
     def test_table_traverse_full(self):
         all = list(self.table)
         assert len(all)==len(FIXTURES), all
@@ -71,6 +216,125 @@ class WebstoreClientTestCase(unittest.TestCase):
         two = list(self.table.traverse(_limit=2))
         assert len(two)==2, two
 
+    def test_table_traverse_paged(self):
+        paged = list(self.table.traverse(_step=1))
+        assert len(paged)==len(FIXTURES), paged
+        two = list(self.table.traverse(_step=1, _offset=1, _limit=2))
+        assert two==paged[1:3], two
+
+    def test_table_traverse_prefetch(self):
+        paged = list(self.table.traverse(_step=1))
+        prefetched = list(self.table.traverse(_step=1, _prefetch=3,
+                                              _workers=2))
+        assert prefetched==paged, prefetched
+
+    def test_table_traverse_keyset(self):
+        paged = list(self.table.traverse(_step=1, _keyset='__id__'))
+        assert len(paged)==len(FIXTURES), paged
+        ids = [r['__id__'] for r in paged]
+        assert ids==sorted(ids), ids
+        bln = list(self.table.traverse(_keyset='__id__', place='Berlin'))
+        assert len(bln)==1, bln
+        two = list(self.table.traverse(_step=1, _limit=2, _keyset='__id__'))
+        assert two==paged[:2], two
+
+    def test_table_traverse_adaptive(self):
+        rows = list(self.table.traverse(_step=1, _adaptive=PageSizer(
+            min_step=1, target_time=None, target_bytes=1e6)))
+        assert len(rows)==len(FIXTURES), rows
+        assert rows[-1]['place']==FIXTURES[-1]['place'], rows
+        rows = list(self.table.traverse(_adaptive=True, _limit=3, _offset=1))
+        assert len(rows)==3, rows
+        sizer = PageSizer(min_step=10, max_step=1000, target_time=1)
+        assert sizer.next_step(100, 100, 0.1, 1000)==200
+        assert sizer.next_step(100, 100, 4, 1000)==50
+        assert sizer.next_step(100, 100, 4, 1000)==50
+        assert sizer.next_step(800, 800, 0.1, 1000)==1000
+        self.assertRaises(ValueError, list, self.table.traverse(
+            _adaptive=True, _stream=True))
+        class Recorder(PageSizer):
+            def next_step(self, step, rows, elapsed, size):
+                timings.append(elapsed)
+                return PageSizer.next_step(self, step, rows, elapsed, size)
+        timings = []
+        for row in self.table.traverse(_step=1, _adaptive=Recorder(
+                min_step=1, target_time=0.05)):
+            sleep(0.1)
+        assert timings and max(timings) < 0.1, timings
+
+    def test_table_traverse_stream(self):
+        paged = list(self.table.traverse(_step=3))
+        streamed = list(self.table.traverse(_step=3, _stream=True))
+        assert streamed==paged, streamed
+        bln = list(self.table.traverse(_stream=True, place='Berlin'))
+        assert bln==[r for r in paged if r['place']=='Berlin'], bln
+
+    def test_async_table_traverse(self):
+        database = AsyncDatabase(self.server_url, 'test', 'test',
+                                 port=self.port)
+        assert 'test' in database.tables().result()
+        rows = []
+        count = database['test'].traverse(rows.append, _step=1).result()
+        assert count==len(FIXTURES), count
+        assert rows==list(self.table), rows
+        table = database['test']
+        table.writerows([{'place': 'Town%d' % i} for i in range(1100)],
+                        bufferlen=5000)
+        table.flush().result()
+        count = table.traverse(lambda row: None, _step=1).result()
+        assert count==len(FIXTURES)+1100, count
+
+    def test_stream_array_chunks(self):
+        class Chunked(object):
+            def __init__(self, data, size):
+                self.data, self.size = StringIO(data), size
+            def read(self, amt):
+                return self.data.read(self.size)
+        data = '{"count": 3, "rows": [{"a": 1}, {"a": 22}, {"a": 333}]}'
+        for size in range(1, len(data)+1):
+            calls = []
+            def hook(pairs):
+                calls.append(pairs)
+                return dict(pairs)
+            decoder = JSONDecoder(object_pairs_hook=hook)
+            rows = list(_stream_array(Chunked(data, size), 'rows', decoder))
+            assert rows==[{'a': 1}, {'a': 22}, {'a': 333}], (size, rows)
+            assert len(calls)==3, (size, calls)
+            numbers = list(_stream_array(Chunked('{"r": [12345, 6]}', size),
+                                         'r'))
+            assert numbers==[12345, 6], (size, numbers)
+
+    def test_table_fetch_columns(self):
+        columns = self.table.fetch_columns(['place', 'temp'], _step=3,
+                                           dtype_map={'temp': 'd'})
+        assert columns.keys()==['place', 'temp'], columns
+        assert columns['place']==[r['place'] for r in self.table], columns
+        assert columns['temp'].typecode=='d', columns
+        assert sum(columns['temp'])==31, columns
+        try:
+            import numpy
+        except ImportError:
+            return
+        flags = self.database['flags']
+        flags.writerows([{'flag': u'y'}, {'flag': u'n'}])
+        arrays = flags.fetch_columns(['flag'], dtype_map={'flag': 'u'},
+                                     as_numpy=True)
+        flags.delete()
+        assert arrays['flag'].tolist()==[u'y', u'n'], arrays
+
+    def test_table_traverse_row_factory(self):
+        dicts = list(self.table)
+        rows = list(self.table.traverse(_row_factory=Row))
+        assert [dict(r) for r in rows]==dicts, rows
+        assert rows[0]['place']==rows[0].place==dicts[0]['place'], rows
+        assert rows[0]._columns is rows[-1]._columns, rows
+        self.assertRaises(TypeError, hash, rows[0])
+        streamed = list(self.table.traverse(_row_factory=Row, _step=3,
+                                            _stream=True))
+        assert streamed==rows, streamed
+        self.table.row_factory = Row
+        assert isinstance(iter(self.table).next(), Row)
+
     def test_table_add_row(self):
         row = {'place': 'Tokyo', 'radiation': '5usv'}
         self.table.writerow(row)
@@ -80,6 +344,203 @@ class WebstoreClientTestCase(unittest.TestCase):
         tok = list(self.table.traverse(place='Tokyo'))
         assert tok[0]['radiation']=='5usv', tok
     
+    def test_table_write_chunks(self):
+        rows = ({'place': 'Town%s' % i, 'temp': str(i)} for i in range(10))
+        results = self.table.writerows(rows, chunk_rows=3, workers=2)
+        assert len(results)==4, results
+        assert len(list(self.table))==len(FIXTURES)+10
+        results = self.table.writerows(FIXTURES, chunk_bytes=1,
+                                       unique_columns=['place'])
+        assert len(results)==len(FIXTURES), results
+        assert len(list(self.table))==len(FIXTURES)+10
+
+    def test_table_write_stream(self):
+        rows = ({'place': 'Town%s' % i, 'temp': str(i)} for i in range(100))
+        self.table.writerows(rows, stream=True)
+        assert len(list(self.table))==len(FIXTURES)+100
+
+    def test_retry_policy(self):
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise socket.error('Connection reset by peer')
+            return 'ok'
+        policy = RetryPolicy(retries=5, backoff=0)
+        assert policy.call(flaky)=='ok'
+        assert len(calls)==3, calls
+        del calls[:]
+        self.assertRaises(socket.error, RetryPolicy(retries=1,
+                          backoff=0).call, flaky)
+        assert len(calls)==2, calls
+        del calls[:]
+        retried = []
+        assert policy.call(flaky, _on_retry=retried.append)=='ok'
+        assert len(retried)==2, retried
+        stats = ClientStats()
+        database = Database(self.server_url, 'test', 'test', port=self.port,
+                            retry=policy, stats=stats)
+        del calls[:]
+        assert database._retrying(flaky)=='ok'
+        assert stats.as_dict()['retries']==2, stats.as_dict()
+        assert len(list(database['test'].traverse(_step=2)))==len(FIXTURES)
+        self.assertRaises(WebstoreClientException,
+                          list, database['missing'].traverse())
+
+    def test_database_stats(self):
+        stats = ClientStats()
+        requests = []
+        database = Database(self.server_url, 'test', 'test', port=self.port,
+                            stats=stats,
+                            hooks={'before_request': [],
+                                   'after_request': [requests.append]})
+        table = database['test']
+        assert len(list(table.traverse(_step=2)))==len(FIXTURES)
+        table.writerows(FIXTURES, unique_columns=['place'])
+        data = stats.as_dict()
+        assert data['endpoints']['GET table']['count']==3, data
+        assert data['endpoints']['GET table']['bytes_received'] > 0, data
+        assert data['endpoints']['POST table']['bytes_sent'] > 0, data
+        assert sum(c for b, c in data['endpoints']['GET table']['latency'])==3
+        assert data['decode_count']==4, data
+        assert data['encode_count']==1, data
+        assert len(requests)==4, requests
+        assert requests[0]['endpoint']=='GET table', requests
+        assert requests[0]['status']==200, requests
+        stats.reset()
+        assert stats.as_dict()['endpoints']=={}
+
+    def test_table_raw_json(self):
+        database = Database(self.server_url, 'test', 'test', port=self.port,
+                            codec=get_codec('json'))
+        table = database['test']
+        table.writerows([RawJSON('{"place": "Oslo", "temp": "3"}'),
+                         {'place': 'Rome'}])
+        table.writerows(RawJSON('[{"place": "Bern"}]'))
+        table.writerows([RawJSON('{"place": "Lima"}')], stream=True)
+        assert table.find_one(place='Oslo')['temp']=='3'
+        assert len(list(table))==len(FIXTURES)+4
+        assert database.query('SELECT 1 AS one')['data']==[{'one': 1}]
+        self.assertRaises(ValueError, get_codec, 'yaml')
+
+    def test_get_codec_selection(self):
+        import webstore.client
+        class FakeUltraJSON(object):
+            def dumps(self, value, double_precision=None):
+                calls.append(('dumps', double_precision))
+                return 'ujson'
+            def loads(self, data, precise_float=False):
+                calls.append(('loads', precise_float))
+                return 'ujson'
+        calls = []
+        saved = sys.modules.get('ujson'), dict(webstore.client._codecs)
+        try:
+            webstore.client._codecs.clear()
+            sys.modules['ujson'] = FakeUltraJSON()
+            codec = get_codec()
+            assert codec.loads('[1]')=='ujson', codec
+            assert codec.dumps(0.1 + 0.2)=='0.30000000000000004', codec
+            assert calls==[('loads', True)], calls
+            assert get_codec('ujson').dumps(1.5)=='ujson'
+            assert calls[-1]==('dumps', 15), calls
+            webstore.client._codecs.clear()
+            sys.modules['ujson'] = None
+            assert get_codec().loads('[1]')==[1]
+            self.assertRaises(ValueError, get_codec, 'ujson')
+        finally:
+            if saved[0] is None:
+                sys.modules.pop('ujson', None)
+            else:
+                sys.modules['ujson'] = saved[0]
+            webstore.client._codecs.clear()
+            webstore.client._codecs.update(saved[1])
+
+    def test_table_load_file(self):
+        path = tempfile.mktemp(suffix='.csv')
+        with open(path, 'wb') as fh:
+            fh.write('place,temp\nOslo,-3\nRome,\n\nLima,19\n')
+        count = self.table.load_file(path, types={'temp': int},
+                                     chunk_rows=2, workers=1)
+        assert count==3, count
+        oslo = self.table.find_one(place='Oslo')
+        assert oslo['temp']==-3, oslo
+        path = tempfile.mktemp(suffix='.jsonl')
+        with open(path, 'wb') as fh:
+            fh.write('{"place": "Oslo", "temp": 4}\n\n{"place": "Bern"}\n')
+        count = self.table.load_file(path, unique_columns=['place'])
+        assert count==2, count
+        assert len(list(self.table))==len(FIXTURES)+4
+        self.assertRaises(ValueError, self.table.load_file, path, 'xml')
+
+    def test_table_mirror(self):
+        path = tempfile.mktemp(suffix='.db')
+        mirror = self.table.mirror(path, step=2)
+        assert len(mirror)==len(FIXTURES), len(mirror)
+        berlin = list(mirror.traverse(place='Berlin'))
+        assert berlin[0]['temp']=='5', berlin
+        assert mirror.sync()==0
+        self.table.writerows([{'place': 'Paris', 'temp': '12'}])
+        assert mirror.sync()==1
+        mirror.close()
+        mirror = self.table.mirror(path)
+        assert len(mirror)==len(FIXTURES)+1, len(mirror)
+        rows = list(mirror.traverse(_sort=[('temp', 'desc')], _limit=2))
+        assert rows[0]['place']=='Berlin', rows
+        assert mirror.sync(full=True)==len(FIXTURES)+1
+        mirror.close()
+
+    def test_table_traverse_where(self):
+        where = (col('humidity') > '0.5') & col('place').in_(['Berlin',
+                                                              'Kairo'])
+        rows = list(self.table.traverse(_where=where, _columns=['place']))
+        assert rows==[{'place': 'Berlin'}, {'place': 'Kairo'}], rows
+        rows = list(self.table.traverse(_where=~(col('place') == 'London'),
+                                        _sort=[('place', 'desc')], _step=1))
+        assert [r['place'] for r in rows]==['Novosibirsk', 'Kairo',
+                                            'Berlin'], rows
+        where = col('place').like('%o%') | (col('temp') == None)
+        rows = list(self.table.traverse(_where=where, _keyset='__id__',
+                                        _columns=['temp'], _step=1))
+        assert [r['temp'] for r in rows]==['-10', '35', '1'], rows
+        assert self.table.count(_where=col('temp').between('0', '4'))==2
+        self.assertRaises(ValueError, list, self.table.traverse(
+            _where=where, _stream=True))
+
+    def test_sharded_table(self):
+        other = Database(self.server_url, 'test', 'test2', port=self.port)
+        other['test'].writerows([{'place': 'Oslo', 'temp': '2'},
+                                 {'place': 'Rome', 'temp': '21'}])
+        try:
+            shards = ShardedTable([self.database, other], 'test')
+            assert len(list(shards))==len(FIXTURES)+2
+            rows = list(shards.traverse(_sort=[('place', 'asc')], _step=1))
+            places = [r['place'] for r in rows]
+            assert places==sorted(places), places
+            rows = list(shards.traverse(_sort=[('place', 'desc')], _limit=3,
+                                        _offset=1))
+            assert [r['place'] for r in rows]==['Oslo', 'Novosibirsk',
+                                                'London'], rows
+            assert shards.count()==len(FIXTURES)+2
+            assert shards.count(place='Oslo')==1
+        finally:
+            other['test'].delete()
+
+    def test_table_aggregate(self):
+        assert self.table.count()==len(FIXTURES)
+        assert self.table.count(place='Berlin')==1
+        assert self.table.count(place='Atlantis')==0
+        self.table.writerows([{'place': 'Berlin', 'temp': '7'}])
+        result = self.table.aggregate({'temp': ['min', 'count'],
+                                       'humidity': 'max'})
+        assert result['count_temp']==len(FIXTURES)+1, result
+        assert result['max_humidity']=='0.9', result
+        groups = self.table.aggregate({'temp': 'count'}, group_by=['place'])
+        assert groups[0]=={'place': 'Berlin', 'count_temp': 2}, groups
+        assert len(groups)==len(FIXTURES), groups
+        result = self.table.aggregate({'temp': 'max'}, place='Berlin')
+        assert result=={'max_temp': '7'}, result
+        self.assertRaises(ValueError, self.table.aggregate, {'temp': 'mode'})
+
     def test_table_update_row(self):
         row = {'place': 'Berlin', 'radiation': '5usv'}
         self.table.writerow(row, unique_columns=['place'])
@@ -88,6 +549,32 @@ class WebstoreClientTestCase(unittest.TestCase):
         tok = list(self.table.traverse(place='Berlin'))
         assert tok[0]['radiation']=='5usv', tok
     
+    def test_table_background_writer(self):
+        with self.table.start_writer(bufferlen=2, max_age=0.1) as table:
+            for i in range(5):
+                table.writerow({'place': 'Town%s' % i, 'temp': i})
+            table.flush()
+            assert len(list(self.table))==len(FIXTURES)+5
+            table.writerows({'place': 'Gen%s' % i} for i in range(3))
+            table.flush()
+            assert len(list(self.table))==len(FIXTURES)+8
+            table.writerow({'place': 'Berlin', 'temp': '7'},
+                           unique_columns=['place'])
+        bln = list(self.table.traverse(place='Berlin'))
+        assert bln[0]['temp']=='7', bln
+
+    def test_table_cached_reads(self):
+        database = Database(self.server_url, 'test', 'test',
+                port=self.port, cache=ResponseCache(ttl=60))
+        table = database['test']
+        all = list(table)
+        assert list(table)==all, all
+        assert len(database.cache), database.cache
+        table.writerow({'place': 'Tokyo', 'radiation': '5usv'})
+        assert len(list(table))==len(all)+1
+        table.delete()
+        assert 'test' not in database
+
     def test_table_delete(self):
         self.table.delete()
         assert not 'test' in self.database
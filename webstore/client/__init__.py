@@ -1,18 +1,43 @@
 import os
+import sys
+import csv
+import zlib
+import gzip
+import array
+import codecs
+import socket
+import random
+import select
+from time import time, sleep
+from base64 import b64encode
+import heapq
+from Queue import Queue, Empty, Full
+from threading import Lock, Thread, Event, Condition
 from urlparse import urljoin, urlparse
-from collections import defaultdict
-from urllib import urlencode
+from collections import defaultdict, deque, OrderedDict
+from urllib import urlencode, unquote
+from itertools import chain
+from StringIO import StringIO
 try:
-    from json import loads, dumps
+    from json import loads, dumps, JSONDecoder
 except ImportError:
-    from simplejson import loads, dumps
+    from simplejson import loads, dumps, JSONDecoder
 
 import ConfigParser
-from httplib import HTTPConnection
+from httplib import HTTPConnection, HTTPException, IncompleteRead
 
 ASCENDING = 'asc'
 DESCENDING = 'desc'
 SEP = '||||'
+CHUNK_SIZE = 16 * 1024
+BATCH_ROWS = 10000
+BATCH_BYTES = 4 * 1024 * 1024
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+def _quote_identifier(name):
+    """ Quote a table or column name for use in an SQL statement. """
+    return '"%s"' % name.replace('"', '""')
 
 def DSN(name, config_file=None):
     """ Create a database from a data source name.
@@ -93,6 +118,102 @@ def URL(url, default_table=None):
     return (db, table)
 
 
+class _Columns(tuple):
+    """ The column names shared by the rows of a traversal, with a
+    lookup of each name's position. """
+
+    def __new__(cls, names):
+        self = tuple.__new__(cls, names)
+        self.positions = dict((n, i) for i, n in enumerate(names))
+        return self
+
+
+class Row(object):
+    """ A compact, read-only row that can be used in place of the row
+    dictionaries returned by ``Table.traverse``. A row only holds a 
+    tuple of values, the column names are shared by all rows of a page.
+    Values can be accessed by column name (``row['place']`` or 
+    ``row.place``) or by position, and ``dict(row)`` converts a row
+    back into a dictionary. """
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, columns, values):
+        self._columns = columns
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, slice)):
+            return self._values[key]
+        return self._values[self._columns.positions[key]]
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, key, default=None):
+        position = self._columns.positions.get(key)
+        return default if position is None else self._values[position]
+
+    def keys(self):
+        return list(self._columns)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._columns, self._values)
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._columns.positions
+
+    def __eq__(self, other):
+        if isinstance(other, (Row, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    # rows compare equal to dictionaries, which can not be hashed.
+    __hash__ = None
+
+    def __repr__(self):
+        return "<Row(%s)>" % ', '.join('%s=%r' % i for i in self.items())
+
+
+class _RowBuilder(object):
+    """ Creates rows with a row factory, re-using one ``_Columns`` for
+    all rows that have the same columns. """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._columns = {}
+
+    def _build(self, names, values):
+        columns = self._columns.get(names)
+        if columns is None:
+            columns = self._columns[names] = _Columns(names)
+        return self.factory(columns, values)
+
+    def __call__(self, pairs):
+        """ Build a row from decoded (key, value) pairs, for use as an
+        ``object_pairs_hook``. """
+        return self._build(tuple([k for k, v in pairs]),
+                           tuple([v for k, v in pairs]))
+
+    def from_dict(self, row):
+        return self._build(tuple(row.keys()), tuple(row.values()))
+
+
 class WebstoreClientException(Exception):
     """ A simple exception for webstore errors which have been
     transmitted to the client. Note that some success messages are 
@@ -122,8 +243,1345 @@ class WebstoreClientException(Exception):
         return self.message.encode('utf-8')
 
     def __repr__(self):
-        return "<WebstoreClientException(%s: %s)>" (self.state, 
-                                                    self.message)
+        return "<WebstoreClientException(%s: %s)>" % (self.state, 
+                                                      self.message)
+
+AGGREGATES = {'sum': 'SUM', 'min': 'MIN', 'max': 'MAX', 'avg': 'AVG',
+              'count': 'COUNT'}
+
+
+def _filter_clause(filters, where=None):
+    """ Build a list of SQL conditions and their parameters requiring
+    the columns in `filters` to have the given values and, if given,
+    the ``Expression`` `where` to hold. """
+    conditions = ['%s = ?' % _quote_identifier(k) for k, v in filters]
+    params = [v for k, v in filters]
+    if where is not None:
+        sql, where_params = where.compile()
+        conditions.append(sql)
+        params.extend(where_params)
+    return conditions, params
+
+
+class Expression(object):
+    """ A condition on the rows of a table, compiled to SQL with the
+    values bound as parameters. Expressions are built from ``col`` and
+    combined with ``&`` (and), ``|`` (or) and ``~`` (not)::
+
+      hot = (col('temp') > 30) & ~col('place').in_(['Kairo', 'Dubai'])
+      rows = table.traverse(_where=hot, _columns=['place', 'temp'])
+
+    Note that the comparisons need parentheses, as ``&`` and ``|`` bind
+    more tightly than ``>``. """
+
+    def __init__(self, sql, params=()):
+        self.sql = sql
+        self.params = tuple(params)
+
+    def compile(self):
+        """ Get the SQL for this condition and the list of values to 
+        bind to its ``?`` placeholders. """
+        return self.sql, list(self.params)
+
+    def _combine(self, operator, other):
+        if not isinstance(other, Expression):
+            raise TypeError("Cannot combine an expression with %r" % other)
+        return Expression('(%s %s %s)' % (self.sql, operator, other.sql),
+                          self.params + other.params)
+
+    def __and__(self, other):
+        return self._combine('AND', other)
+
+    def __or__(self, other):
+        return self._combine('OR', other)
+
+    def __invert__(self):
+        return Expression('NOT %s' % self.sql, self.params)
+
+    def __nonzero__(self):
+        raise TypeError("Expressions have no truth value, combine them "
+                        "with & and | instead of 'and' and 'or'.")
+
+    def __repr__(self):
+        return "<Expression(%s %r)>" % (self.sql, self.params)
+
+
+class Column(object):
+    """ A column of a table, to build an ``Expression`` from. Compare
+    it with a value using ``==``, ``!=``, ``<``, ``<=``, ``>`` or ``>=``
+    (comparing with ``None`` tests for ``NULL``), or use one of the 
+    methods below. """
+
+    def __init__(self, name):
+        self.name = name
+        self.sql = _quote_identifier(name)
+
+    def _compare(self, operator, value):
+        return Expression('%s %s ?' % (self.sql, operator), [value])
+
+    def __eq__(self, value):
+        if value is None:
+            return self.is_null()
+        return self._compare('=', value)
+
+    def __ne__(self, value):
+        if value is None:
+            return self.is_not_null()
+        return self._compare('!=', value)
+
+    def __lt__(self, value):
+        return self._compare('<', value)
+
+    def __le__(self, value):
+        return self._compare('<=', value)
+
+    def __gt__(self, value):
+        return self._compare('>', value)
+
+    def __ge__(self, value):
+        return self._compare('>=', value)
+
+    __hash__ = None
+
+    def in_(self, values):
+        """ The column has one of `values`. """
+        values = list(values)
+        if not len(values):
+            return Expression('0 = 1')
+        return Expression('%s IN (%s)' % (self.sql,
+            ', '.join('?' * len(values))), values)
+
+    def between(self, low, high):
+        """ The column is at least `low` and at most `high`. """
+        return Expression('%s BETWEEN ? AND ?' % self.sql, [low, high])
+
+    def like(self, pattern):
+        """ The column matches an SQL ``LIKE`` pattern. """
+        return Expression('%s LIKE ?' % self.sql, [pattern])
+
+    def is_null(self):
+        return Expression('%s IS NULL' % self.sql)
+
+    def is_not_null(self):
+        return Expression('%s IS NOT NULL' % self.sql)
+
+    def __repr__(self):
+        return "<Column(%s)>" % self.name
+
+
+def col(name):
+    """ Refer to the column `name` in an ``Expression``. """
+    return Column(name)
+
+
+def _traverse_query(sort, filters):
+    """ Build the query parameters for traversing a table. """
+    query = filters.items()
+    query.extend([('_sort', '%s:%s' % (v, k)) for k, v in sort])
+    return query
+
+
+def _page_windows(step, limit, offset):
+    """ Generate the (offset, limit) of each page to request. """
+    end = None if limit is None else offset + limit
+    while end is None or offset < end:
+        page = step if end is None else min(step, end - offset)
+        yield offset, page
+        offset += page
+
+
+def _page_path(query, offset, limit):
+    """ Get the relative path for one page of a traversal. """
+    page_query = list(query)
+    page_query.append(('_offset', offset))
+    page_query.append(('_limit', limit))
+    qs = urlencode([(k, unicode(v).encode('utf-8')) for \
+                    k, v in page_query])
+    return '?' + qs
+
+
+class RawJSON(str):
+    """ A value that has already been encoded as JSON. It is sent as it
+    is instead of being encoded again, e.g. a row read from a JSON 
+    file or a whole request body::
+
+      table.writerows(RawJSON(line) for line in open('rows.jsonl'))
+    """
+
+
+class JSONCodec(object):
+    """ Encodes request bodies and decodes responses using the ``json``
+    module of the standard library. Other codecs wrap faster libraries
+    with the same `dumps` and `loads` methods; see `get_codec`. 
+    Responses that are decoded incrementally, e.g. in streamed 
+    traversals, always use the standard library. """
+    name = 'json'
+
+    def dumps(self, value):
+        return dumps(value)
+
+    def loads(self, data):
+        return loads(data)
+
+    def __repr__(self):
+        return "<%s(%s)>" % (self.__class__.__name__, self.name)
+
+
+class UltraJSONCodec(JSONCodec):
+    """ A codec using the ``ujson`` library, which is several times 
+    faster than the standard library. ``ujson`` writes floats with at
+    most 15 decimals, so floats that need more digits lose precision
+    when they are encoded. It is therefore only used to encode if it
+    is asked for by name; see `get_codec`. Floats are decoded with
+    ``ujson``'s precise parser, so they read the same as with the
+    standard library. """
+    name = 'ujson'
+    double_precision = 15
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, value):
+        return self._ujson.dumps(value,
+                                 double_precision=self.double_precision)
+
+    def loads(self, data):
+        return self._ujson.loads(data, precise_float=True)
+
+
+class _UltraJSONLoads(UltraJSONCodec):
+    """ Decodes with ``ujson`` but encodes with the standard library,
+    which writes floats exactly. """
+
+    def dumps(self, value):
+        return dumps(value)
+
+
+CODECS = [UltraJSONCodec, JSONCodec]
+DEFAULT_CODECS = [_UltraJSONLoads, JSONCodec]
+_codecs = {}
+
+
+def get_codec(name=None):
+    """ Get a JSON codec by `name` ('json' or 'ujson'). If no name is
+    given, responses are decoded with ``ujson`` if it is installed,
+    while bodies are always encoded with the standard library so that
+    floats are sent without loss. Raises ``ValueError`` for unknown or
+    unavailable codecs. """
+    if name not in _codecs:
+        if name is None:
+            candidates = DEFAULT_CODECS
+        else:
+            candidates = [cls for cls in CODECS if cls.name == name]
+            if not len(candidates):
+                raise ValueError("Unknown JSON codec: %s" % name)
+        for cls in candidates:
+            try:
+                _codecs[name] = cls()
+                break
+            except ImportError:
+                if name is not None:
+                    raise ValueError("JSON codec not available: %s" % name)
+    return _codecs[name]
+
+
+def _batches(rows, batch_rows, batch_bytes, dumps=dumps):
+    """ Encode rows as JSON and group them into request bodies of at
+    most `batch_rows` rows and `batch_bytes` bytes. A row larger than
+    `batch_bytes` is sent on its own. Rows that are ``RawJSON`` are 
+    used as they are. Yields (number of rows, body). """
+    encoded, size = [], 2
+    for row in rows:
+        data = row if isinstance(row, RawJSON) else dumps(row)
+        if len(encoded) and ((batch_rows and len(encoded) >= batch_rows) or
+                (batch_bytes and size + len(data) + 1 > batch_bytes)):
+            yield len(encoded), '[' + ','.join(encoded) + ']'
+            encoded, size = [], 2
+        encoded.append(data)
+        size += len(data) + 1
+    if len(encoded):
+        yield len(encoded), '[' + ','.join(encoded) + ']'
+
+
+def _json_chunks(rows, size=CHUNK_SIZE, dumps=dumps):
+    """ Encode rows as a JSON array on the fly, yielding pieces of 
+    about `size` bytes. """
+    parts, length, sep = ['['], 1, ''
+    for row in rows:
+        data = sep + (row if isinstance(row, RawJSON) else dumps(row))
+        sep = ','
+        parts.append(data)
+        length += len(data)
+        if length >= size:
+            yield ''.join(parts)
+            parts, length = [], 0
+    parts.append(']')
+    yield ''.join(parts)
+
+
+def _read_csv(fh, encoding, delimiter):
+    """ Yield the rows of a CSV file with a header line as dictionaries
+    of unicode values. """
+    reader = csv.reader(fh, delimiter=delimiter)
+    header = [h.decode(encoding) for h in next(reader, [])]
+    for line in reader:
+        if len(line):
+            yield dict(zip(header, [v.decode(encoding) for v in line]))
+
+
+def _read_jsonl(fh, encoding, loads=loads):
+    """ Yield the rows of a file with one JSON object per line. """
+    for line in fh:
+        line = line.strip()
+        if line:
+            yield loads(line.decode(encoding))
+
+
+def _coerce(rows, types):
+    """ Convert the values of the columns in `types` with the given
+    functions, turning empty strings into ``None``. """
+    for row in rows:
+        for name, convert in types.items():
+            value = row.get(name)
+            if value is not None:
+                row[name] = convert(value) if value != '' else None
+        yield row
+
+
+def _gzip(data):
+    """ Compress a request body with gzip. """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gzip_chunks(chunks):
+    """ Compress a streamed request body with gzip. """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _decompressor(encoding):
+    """ Get a decompressor for the given ``Content-Encoding``, or 
+    ``None`` if the body is not compressed. """
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return zlib.decompressobj()
+    return None
+
+
+class _DecompressingReader(object):
+    """ A file-like view on a compressed response body. """
+
+    def __init__(self, fh, decompressor):
+        self._fh = fh
+        self._decompressor = decompressor
+        self._eof = False
+
+    def read(self, amt=CHUNK_SIZE):
+        while not self._eof:
+            chunk = self._fh.read(amt)
+            if not chunk:
+                self._eof = True
+                return self._decompressor.flush()
+            data = self._decompressor.decompress(chunk)
+            if data:
+                return data
+        return ''
+
+
+class _JSONStream(object):
+    """ A window on a JSON document that is read incrementally from
+    a file-like object, holding only the text that has not been
+    decoded yet. """
+
+    def __init__(self, fh, chunk_size=CHUNK_SIZE):
+        self._fh = fh
+        self._chunk_size = chunk_size
+        self._decoder = JSONDecoder()
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof:
+            raise ValueError("Unexpected end of JSON data")
+        chunk = self._fh.read(self._chunk_size)
+        self._eof = not chunk
+        self._buf = self._buf[self._pos:] + self._decode(chunk, self._eof)
+        self._pos = 0
+
+    def peek(self):
+        """ Skip whitespace and return the next character. """
+        while True:
+            while self._pos < len(self._buf) and \
+                    self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            self._fill()
+
+    def expect(self, chars):
+        """ Consume the next character, which must be one of `chars`. """
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected %r, got %r" % (chars, char))
+        self._pos += 1
+        return char
+
+    def value(self, decoder=None):
+        """ Decode the next complete JSON value, using `decoder` instead
+        of a plain ``JSONDecoder`` if given. """
+        decoder = decoder or self._decoder
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self._buf, self._pos)
+                # only a bare number may continue in the part not read
+                # yet; decoding anything else again would run the
+                # decoder's hooks twice for the same value.
+                if self._eof or not isinstance(value, (int, long, float)) \
+                        or (end < len(self._buf) and
+                            self._buf[end] not in '0123456789.eE+-'):
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof:
+                    raise
+            self._fill()
+
+
+def _stream_array(fh, key, decoder=None):
+    """ Decode the JSON object read from `fh` and yield the elements of
+    the array stored under `key` one at a time, as they arrive. The
+    elements are decoded with `decoder`, if given. """
+    stream = _JSONStream(fh)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        name = stream.value()
+        stream.expect(':')
+        if name != key:
+            stream.value()
+        else:
+            stream.expect('[')
+            if stream.peek() == ']':
+                return
+            while True:
+                yield stream.value(decoder)
+                if stream.expect(',]') == ']':
+                    return
+        if stream.expect(',}') == '}':
+            return
+
+
+# NumPy types for the ``array`` type codes of characters; the numeric
+# type codes name the same C types in both.
+_NUMPY_CHARS = {'c': 'S1', 'u': 'U1'}
+
+
+def _column_appender(column, buf):
+    """ Get a function appending a JSON value to a column buffer,
+    converting it to the type of the buffer. """
+    if isinstance(buf, list):
+        return buf.append
+    if buf.typecode in 'fd':
+        nan = float('nan')
+        return lambda v: buf.append(nan if v is None else float(v))
+    if buf.typecode in 'cu':
+        return buf.append
+
+    def _append(value):
+        if value is None:
+            raise ValueError("Column %s contains NULL values, which can "
+                             "not be stored in an integer array." % column)
+        buf.append(int(value))
+    return _append
+
+
+class WebstoreWriteError(Exception):
+    """ Raised when some of the chunks of a write could not be
+    uploaded. All other chunks have been written. """
+
+    def __init__(self, errors, results):
+        self.errors = errors
+        self.results = results
+        Exception.__init__(self, "%s of %s chunks failed to write: %s" % (
+            len(errors), len(results), errors[0][-1]))
+
+
+class _Future(object):
+    """ The pending result of a call submitted to a ``_WorkerPool``. """
+
+    def __init__(self):
+        self._event = Event()
+        self._result = None
+        self._error = None
+
+    def _set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def _set_error(self, exc_info):
+        self._error = exc_info
+        self._event.set()
+
+    @classmethod
+    def call(cls, func, *args, **kwargs):
+        """ Run `func` right away and return its outcome as a future. """
+        future = cls()
+        try:
+            future._set_result(func(*args, **kwargs))
+        except Exception:
+            future._set_error(sys.exc_info())
+        return future
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """ Wait for the call to finish and return its result, or
+        re-raise the exception it raised. """
+        if not self._event.wait(timeout):
+            raise socket.timeout('Timed out waiting for result.')
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+
+class _WorkerPool(object):
+    """ A fixed number of daemon threads running submitted calls. """
+
+    def __init__(self, workers):
+        self._queue = Queue()
+        self._closed = False
+        self._threads = []
+        for i in range(max(1, workers)):
+            thread = Thread(target=self._work, name='webstore-worker')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None or self._closed:
+                return
+            future, func, args, kwargs = item
+            try:
+                future._set_result(func(*args, **kwargs))
+            except Exception:
+                future._set_error(sys.exc_info())
+
+    def submit(self, func, *args, **kwargs):
+        future = _Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self):
+        """ Stop the workers once their current call is done, dropping
+        any calls that have not been started. """
+        self._closed = True
+        for thread in self._threads:
+            self._queue.put(None)
+
+
+class _BackgroundWriter(Thread):
+    """ Uploads the write buffer of a ``Table`` on a background thread
+    whenever a key has collected enough rows or bytes, or its oldest
+    row has waited long enough. """
+
+    def __init__(self, table, bufferlen, max_bytes, max_age, max_buffered):
+        Thread.__init__(self, name='webstore-writer')
+        self.daemon = True
+        self.table = table
+        self.bufferlen = bufferlen
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_buffered = max_buffered
+        self._cond = Condition()
+        self._bytes = defaultdict(int)
+        self._since = {}
+        self._pending = 0
+        self._flushing = 0
+        self._closed = False
+        self._error = None
+
+    def _check(self):
+        """ Re-raise the last upload error in the calling thread. """
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+    def add(self, rows, unique_columns):
+        """ Buffer `rows`, blocking while too many rows are waiting to
+        be uploaded. """
+        rows = list(rows)
+        key = SEP.join(unique_columns)
+        if self.max_bytes:
+            # encode once here, the upload sends the rows as they are.
+            dumps = self.table.codec.dumps
+            rows = [r if isinstance(r, RawJSON) else RawJSON(dumps(r))
+                    for r in rows]
+        with self._cond:
+            self._check()
+            while self.max_buffered and self._pending >= self.max_buffered:
+                self._cond.wait()
+                self._check()
+            if not len(self.table._buffer[key]):
+                self._since[key] = time()
+            self.table._buffer[key].extend(rows)
+            self._pending += len(rows)
+            if self.max_bytes:
+                self._bytes[key] += sum(len(r) for r in rows)
+            self._cond.notify_all()
+
+    def _due(self, now):
+        for key, rows in self.table._buffer.items():
+            if not len(rows):
+                continue
+            if self._flushing or self._closed or \
+                    (self.bufferlen and len(rows) >= self.bufferlen) or \
+                    (self.max_bytes and self._bytes[key] >= self.max_bytes) or \
+                    (self.max_age is not None and
+                     now - self._since[key] >= self.max_age):
+                return key
+
+    def _timeout(self, now):
+        if self.max_age is None or not len(self._since):
+            return None
+        return max(0, min(self._since.values()) + self.max_age - now)
+
+    def run(self):
+        while True:
+            with self._cond:
+                key = self._due(time())
+                while key is None:
+                    if self._closed:
+                        return
+                    self._cond.wait(self._timeout(time()))
+                    key = self._due(time())
+                rows, self.table._buffer[key] = self.table._buffer[key], []
+                del self._since[key]
+                self._bytes[key] = 0
+            try:
+                self.table._write(rows, key.split(SEP) if key else [])
+            except Exception:
+                with self._cond:
+                    self._error = sys.exc_info()
+            with self._cond:
+                self._pending -= len(rows)
+                self._cond.notify_all()
+
+    def flush(self):
+        """ Upload all buffered rows and wait until they are written. """
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._pending and self._error is None:
+                    self._cond.wait()
+            finally:
+                self._flushing -= 1
+            self._check()
+
+    def close(self):
+        """ Upload all buffered rows, then stop the thread. """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.join()
+        self._check()
+
+
+class PageSizer(object):
+    """ Adapts the page size of a traversal to the table. After each
+    page, the size is scaled towards the number of rows that would take
+    `target_time` seconds to fetch and decode, or take up `target_bytes`
+    bytes, whichever is fewer::
+
+      for row in table.traverse(_adaptive=PageSizer(target_time=0.2)):
+          ...
+
+    The size changes by at most `max_factor` per page, so that a single
+    slow response does not collapse it. """
+
+    def __init__(self, min_step=100, max_step=100000, target_time=0.5,
+                 target_bytes=4 * 1024 * 1024, max_factor=2.0):
+        """ Create a new page sizer.
+
+        :Parameters:
+            - `min_step`: the smallest page size used.
+            - `max_step`: the largest page size used.
+            - `target_time`: the number of seconds a page should take,
+              or ``None``.
+            - `target_bytes`: the size of the response body a page 
+              should have, or ``None``.
+            - `max_factor`: the most the page size grows or shrinks by
+              from one page to the next.
+        """
+        self.min_step = min_step
+        self.max_step = max_step
+        self.target_time = target_time
+        self.target_bytes = target_bytes
+        self.max_factor = max_factor
+
+    def next_step(self, step, rows, elapsed, size):
+        """ Get the size of the next page, given that the last one asked
+        for `step` rows, returned `rows` rows in `elapsed` seconds and
+        had a body of `size` bytes. """
+        factors = []
+        if rows and self.target_time and elapsed > 0:
+            factors.append(self.target_time / elapsed)
+        if rows and self.target_bytes and size > 0:
+            factors.append(self.target_bytes / float(size))
+        if not len(factors):
+            return step
+        factor = max(1 / self.max_factor, min(self.max_factor, min(factors)))
+        step = int(max(step, rows) * factor)
+        return max(self.min_step, min(self.max_step, step))
+
+    def __repr__(self):
+        return "<PageSizer(%s-%s rows)>" % (self.min_step, self.max_step)
+
+
+class RetryPolicy(object):
+    """ Decides whether and when a failed request is sent again. Waits
+    grow exponentially with each attempt and are randomized, so that 
+    clients that failed together do not retry together::
+
+      database = Database('webstore.myserver.org', 'me', 'testdb',
+                          retry=RetryPolicy(retries=8, max_elapsed=600))
+
+    Only requests that can safely be repeated are retried: reads, and
+    writes with `unique_columns`. Traversals resume at the page that 
+    failed rather than starting over. """
+
+    def __init__(self, retries=5, backoff=0.5, max_backoff=30, jitter=0.5,
+                 max_elapsed=300, statuses=(408, 429, 500, 502, 503, 504)):
+        """ Create a new retry policy.
+
+        :Parameters:
+            - `retries`: the maximum number of times a request is retried.
+            - `backoff`: seconds to wait before the first retry, doubled
+              for each further one.
+            - `max_backoff`: the longest wait between two attempts.
+            - `jitter`: the fraction of each wait that is randomized,
+              between 0 and 1.
+            - `max_elapsed`: give up once this many seconds have passed
+              since the first attempt.
+            - `statuses`: the HTTP status codes that are retried. 
+              Connection errors and timeouts are always retried.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.max_elapsed = max_elapsed
+        self.statuses = statuses
+
+    def retryable(self, exc):
+        """ Check whether a request that failed with `exc` may succeed
+        when sent again. """
+        if isinstance(exc, WebstoreClientException):
+            return exc.response.status in self.statuses
+        return isinstance(exc, (socket.error, HTTPException))
+
+    def delay(self, attempt):
+        """ Get the number of seconds to wait before retry `attempt`,
+        counting from 0. """
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay - random.uniform(0, delay * self.jitter)
+
+    def wait(self, exc, attempt, started):
+        """ Wait before retrying a request that failed with `exc`, or
+        return ``False`` if it should not be retried. """
+        if attempt >= self.retries or not self.retryable(exc):
+            return False
+        delay = self.delay(attempt)
+        if time() + delay - started > self.max_elapsed:
+            return False
+        sleep(delay)
+        return True
+
+    def call(self, func, *args, **kwargs):
+        """ Call `func`, retrying it while it fails with retryable 
+        errors. A function given as `_on_retry` is called with the 
+        exception before each retry. """
+        on_retry = kwargs.pop('_on_retry', None)
+        started, attempt = time(), 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception, e:
+                if not self.wait(e, attempt, started):
+                    raise
+                if on_retry is not None:
+                    on_retry(e)
+                attempt += 1
+
+    def __repr__(self):
+        return "<RetryPolicy(%s retries, %ss)>" % (self.retries,
+                                                   self.max_elapsed)
+
+
+class ClientStats(object):
+    """ Collects metrics on the requests made by a ``Database`` and its
+    ``Table`` handles: per endpoint counts, errors, latency histograms 
+    and bytes moved, as well as retries and the time spent encoding and
+    decoding JSON::
+
+      stats = ClientStats()
+      database = Database('webstore.myserver.org', 'me', 'testdb',
+                          stats=stats)
+      list(database['mytable'])
+      report = stats.as_dict()
+
+    Endpoints are named after the method and the kind of resource, 
+    e.g. ``GET table`` or ``PUT database``. Latency is measured until 
+    the response body has been read, so for streamed traversals it
+    includes the time spent decoding the rows. """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """ Create a new collector.
+
+        :Parameters:
+            - `buckets`: the upper bounds of the latency histogram 
+              buckets in seconds, in ascending order. Slower requests
+              are counted in a final, unbounded bucket.
+        """
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """ Discard all metrics collected so far. """
+        with self._lock:
+            self._endpoints = {}
+            self._retries = 0
+            self._timers = defaultdict(lambda: [0, 0.0])
+
+    def record_request(self, endpoint, status, elapsed, sent, received):
+        """ Record a finished request. `status` is ``None`` if no 
+        response was received. """
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = {
+                    'count': 0, 'errors': 0, 'time': 0.0, 'max_time': 0.0,
+                    'bytes_sent': 0, 'bytes_received': 0,
+                    'latency': [0] * (len(self.buckets) + 1)}
+            entry['count'] += 1
+            if status is None or status >= 400:
+                entry['errors'] += 1
+            entry['time'] += elapsed
+            entry['max_time'] = max(entry['max_time'], elapsed)
+            entry['bytes_sent'] += sent
+            entry['bytes_received'] += received
+            for index, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    break
+            else:
+                index = len(self.buckets)
+            entry['latency'][index] += 1
+
+    def record_retry(self):
+        with self._lock:
+            self._retries += 1
+
+    def record_time(self, kind, elapsed):
+        """ Record `elapsed` seconds spent on `kind`, e.g. 'encode' or
+        'decode'. """
+        with self._lock:
+            timer = self._timers[kind]
+            timer[0] += 1
+            timer[1] += elapsed
+
+    def as_dict(self):
+        """ Export the metrics as a dictionary of plain values. Latency
+        histograms are lists of (upper bound, count) pairs, with a bound
+        of ``None`` for the last bucket. """
+        bounds = self.buckets + (None,)
+        with self._lock:
+            endpoints = {}
+            for endpoint, entry in self._endpoints.items():
+                entry = dict(entry)
+                entry['latency'] = zip(bounds, entry['latency'])
+                endpoints[endpoint] = entry
+            data = {'endpoints': endpoints, 'retries': self._retries}
+            for kind, (count, elapsed) in self._timers.items():
+                data[kind + '_count'] = count
+                data[kind + '_time'] = elapsed
+        return data
+
+    def __repr__(self):
+        return "<ClientStats(%s endpoints)>" % len(self._endpoints)
+
+
+def _timed_iter(iterable, stats, kind):
+    """ Iterate over `iterable`, recording the time spent producing 
+    each item as `kind`. """
+    iterator = iter(iterable)
+    while True:
+        started = time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        stats.record_time(kind, time() - started)
+        yield item
+
+
+def _counted_iter(chunks, counter, size=None):
+    """ Pass through `chunks`, adding up their length in `counter`, or
+    a fixed `size` per chunk. """
+    for chunk in chunks:
+        counter[0] += len(chunk) if size is None else size
+        yield chunk
+
+
+class _PooledResponse(object):
+    """ Wraps an ``HTTPResponse`` so that its connection goes back to
+    the pool once the body has been read completely. Without a pool,
+    the connection is closed. """
+
+    def __init__(self, pool, conn, response):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self.received = 0
+        self.on_close = None
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        self.received += len(data)
+        if amt and not data and self._response.length:
+            # the connection was closed before the end of the body.
+            self._response.will_close = True
+            self.close()
+            raise IncompleteRead('', self._response.length)
+        if self._response.isclosed():
+            self.close()
+        return data
+
+    def close(self):
+        """ Release the connection: keep it alive if the body was read
+        to the end and the server allows it, close it otherwise. """
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self.on_close is not None:
+            self.on_close(self)
+        if self._pool is not None and self._response.isclosed() and \
+                not self._response.will_close:
+            self._pool._put(conn)
+        else:
+            self._response.close()
+            conn.close()
+
+
+class _KeepAliveConnection(HTTPConnection):
+    """ An ``HTTPConnection`` with Nagle's algorithm disabled, so that
+    small requests on a kept-alive socket are not delayed. """
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class Transport(object):
+    """ Runs the HTTP requests of a ``Database`` and its ``Table``
+    handles. `request` returns a response with a `status`, a `reason`,
+    `getheader(name, default=None)`, `read(amt=None)` and `close()`,
+    like ``httplib.HTTPResponse``. The response calls its `on_close`
+    attribute, if set, with itself when it is closed, and counts the
+    bytes read in `received`.
+
+    Request bodies are either strings or, for uploads of unknown size,
+    iterables of strings. """
+
+    def request(self, method, path, body=None, headers={}):
+        raise NotImplementedError()
+
+    def close(self):
+        """ Release any resources held by the transport. """
+        pass
+
+    def _send(self, conn, method, path, body, headers):
+        """ Send a request on `conn`, using chunked transfer encoding
+        for a body of unknown length. """
+        if body is None or isinstance(body, basestring):
+            return conn.request(method, path, body, headers)
+        conn.putrequest(method, path,
+                        skip_accept_encoding='Accept-Encoding' in headers)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.endheaders()
+        for chunk in body:
+            if chunk:
+                conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+        conn.send('0\r\n\r\n')
+
+
+class SocketTransport(Transport):
+    """ Opens a new connection for each request and closes it once the 
+    response has been read. """
+
+    def __init__(self, server, port=None, timeout=None):
+        """ Create a transport for requests to `server`.
+
+        :Parameters:
+            - `server`: hostname or IP of the server to connect to.
+            - `port`: server port, defaults to 80.
+            - `timeout`: socket timeout in seconds, if any.
+        """
+        self.server = server
+        self.port = port or 80
+        self.timeout = timeout
+
+    def request(self, method, path, body=None, headers={}):
+        if self.timeout is None:
+            conn = _KeepAliveConnection(self.server, self.port)
+        else:
+            conn = _KeepAliveConnection(self.server, self.port,
+                                        timeout=self.timeout)
+        headers = dict(headers, Connection='close')
+        try:
+            self._send(conn, method, path, body, headers)
+            response = conn.getresponse()
+        except:
+            conn.close()
+            raise
+        return _PooledResponse(None, conn, response)
+
+    def __repr__(self):
+        return "<SocketTransport(%s:%s)>" % (self.server, self.port)
+
+
+class _WSGIResponse(object):
+    """ The response of a WSGI application, read from its iterable. """
+
+    def __init__(self, status, headers, chunks, result):
+        status, _, self.reason = status.partition(' ')
+        self.status = int(status)
+        self.msg = dict((k.lower(), v) for k, v in headers)
+        self.received = 0
+        self.on_close = None
+        self._chunks = chunks
+        self._result = result
+        self._buf = ''
+
+    def getheader(self, name, default=None):
+        return self.msg.get(name.lower(), default)
+
+    def read(self, amt=None):
+        if self._chunks is None:
+            return ''
+        if amt is None:
+            data = self._buf + ''.join(self._chunks)
+            self._buf = ''
+        else:
+            while len(self._buf) < amt:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buf += chunk
+            data, self._buf = self._buf[:amt], self._buf[amt:]
+        self.received += len(data)
+        if not self._buf and (amt is None or not data):
+            self.close()
+        return data
+
+    def close(self):
+        chunks, self._chunks = self._chunks, None
+        if chunks is None:
+            return
+        if self.on_close is not None:
+            self.on_close(self)
+        if hasattr(self._result, 'close'):
+            self._result.close()
+
+
+class WSGITransport(Transport):
+    """ Calls a WSGI application in the same process instead of sending
+    requests over the network, e.g. to use the client in batch jobs or 
+    tests that run next to the webstore application::
+
+      from webstore.web import app
+      database = Database('localhost', 'me', 'testdb',
+                          transport=WSGITransport(app))
+
+    Responses are not compressed, as compressing them would only cost
+    time. Uploads of unknown size are collected into a single body, 
+    since WSGI applications need to know the length of the input. """
+
+    def __init__(self, app, server='localhost', port=80):
+        """ Create a transport for `app`.
+
+        :Parameters:
+            - `app`: the WSGI application to call.
+            - `server`: the host name passed to the application.
+            - `port`: the port passed to the application.
+        """
+        self.app = app
+        self.server = server
+        self.port = port
+
+    def request(self, method, path, body=None, headers={}):
+        if body is not None and not isinstance(body, basestring):
+            body = ''.join(body)
+        body = body or ''
+        url = urlparse(path)
+        environ = {'REQUEST_METHOD': method, 'SCRIPT_NAME': '',
+                   'PATH_INFO': unquote(url.path),
+                   'QUERY_STRING': url.query,
+                   'SERVER_NAME': self.server, 'SERVER_PORT': str(self.port),
+                   'SERVER_PROTOCOL': 'HTTP/1.1',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+                   'wsgi.input': StringIO(body), 'wsgi.errors': sys.stderr,
+                   'wsgi.multithread': True, 'wsgi.multiprocess': False,
+                   'wsgi.run_once': False}
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            if key in ('ACCEPT_ENCODING', 'TRANSFER_ENCODING',
+                       'CONTENT_LENGTH'):
+                continue
+            if key != 'CONTENT_TYPE':
+                key = 'HTTP_' + key
+            environ[key] = str(value)
+        started = []
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            started[:] = [(status, response_headers)]
+            return lambda data: pending.append(data)
+        pending = []
+        result = self.app(environ, start_response)
+        chunks = iter(result)
+        while not started:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            pending.append(chunk)
+        if not started:
+            raise HTTPException("The application did not start a response.")
+        status, response_headers = started[0]
+        return _WSGIResponse(status, response_headers,
+                             chain(pending, chunks), result)
+
+    def __repr__(self):
+        return "<WSGITransport(%r)>" % self.app
+
+
+def _dropped(conn):
+    """ Check whether the server has closed an idle connection. An idle
+    socket only becomes readable when the server closes it, or sends 
+    something that no request is waiting for. """
+    if conn.sock is None:
+        return True
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(conn.sock, select.POLLIN)
+            return bool(poller.poll(0))
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+def _resendable(method, path):
+    """ Check whether a request can be sent again without changing
+    the result: reads, and writes that update rows by unique columns. """
+    if method in ('GET', 'HEAD'):
+        return True
+    query = urlparse(path).query
+    return method == 'POST' and 'unique=' in query
+
+
+class ConnectionPool(Transport):
+    """ A thread-safe pool of HTTP/1.1 keep-alive connections to one
+    server and port. This is the default transport: a ``Database`` 
+    creates one and shares it with all the ``Table`` handles it hands 
+    out. """
+
+    def __init__(self, server, port=None, maxsize=10, idle_timeout=60,
+                 retries=1, timeout=None):
+        """ Create a pool for connections to `server`.
+
+        :Parameters:
+            - `server`: hostname or IP of the server to connect to.
+            - `port`: server port, defaults to 80.
+            - `maxsize`: the maximum number of idle connections kept
+              open for re-use.
+            - `idle_timeout`: seconds after which an idle connection is
+              considered stale and discarded instead of being re-used.
+            - `retries`: how often a request is re-sent on a fresh
+              connection when a re-used one turns out to be stale.
+            - `timeout`: socket timeout in seconds, if any.
+        """
+        self.server = server
+        self.port = port or 80
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.timeout = timeout
+        self._idle = []
+        self._lock = Lock()
+
+    def _connect(self):
+        if self.timeout is None:
+            return _KeepAliveConnection(self.server, self.port)
+        return _KeepAliveConnection(self.server, self.port,
+                                    timeout=self.timeout)
+
+    def _get(self):
+        """ Get an idle connection or a new one, returns a tuple of
+        (connection, re-used). """
+        now = time()
+        with self._lock:
+            while self._idle:
+                conn, since = self._idle.pop()
+                if now - since < self.idle_timeout and not _dropped(conn):
+                    return conn, True
+                conn.close()
+        return self._connect(), False
+
+    def _put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((conn, time()))
+                return
+        conn.close()
+
+    def request(self, method, path, body=None, headers={}):
+        """ Send a request on a pooled connection and return the
+        response. The connection is released once the response body
+        has been read. If `body` is an iterable of strings rather than
+        a string, it is sent with chunked transfer encoding on a new
+        connection, as it cannot be sent again on a stale one.
+
+        A request that failed on a re-used connection while it was sent
+        is sent again. Once it has been sent completely, the server may
+        have handled it, so it is only sent again if that is safe: for
+        GET requests and for writes with unique columns. """
+        streamed = body is not None and not isinstance(body, basestring)
+        attempt = 0
+        while True:
+            if streamed:
+                conn, reused = self._connect(), False
+            else:
+                conn, reused = self._get()
+            sent = False
+            try:
+                self._send(conn, method, path, body, headers)
+                sent = True
+                response = conn.getresponse()
+            except (socket.error, HTTPException):
+                conn.close()
+                if not reused or attempt >= self.retries or \
+                        (sent and not _resendable(method, path)):
+                    raise
+                attempt += 1
+                continue
+            return _PooledResponse(self, conn, response)
+
+    def close(self):
+        """ Close all idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, since in idle:
+            conn.close()
+
+    def __repr__(self):
+        return "<ConnectionPool(%s:%s)>" % (self.server, self.port)
+
+
+class ResponseCache(object):
+    """ A memory-bounded LRU cache for the bodies of GET responses. It
+    can be shared by a ``Database`` and its ``Table`` handles. Entries
+    are served without a request while they are fresh, then revalidated
+    with ``If-None-Match``/``If-Modified-Since`` if the server sent an
+    ``ETag`` or ``Last-Modified`` header. Writes and deletes through a 
+    handle using the cache invalidate the entries of the affected
+    table. Changes made by other clients or by SQL statements run via
+    ``Database.query`` are only seen once entries have expired. """
+
+    def __init__(self, max_bytes=10 * 1024 * 1024, ttl=60):
+        """ Create a new cache.
+
+        :Parameters:
+            - `max_bytes`: the maximum total size of the cached bodies, 
+              the least recently used entries are evicted beyond that.
+            - `ttl`: the number of seconds an entry is served without 
+              asking the server.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = Lock()
+
+    def get(self, key):
+        """ Get the entry for `key` as a tuple of (body, etag, 
+        last_modified, fresh), or ``None``. """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._entries[key] = entry
+        body, etag, last_modified, stored = entry
+        return body, etag, last_modified, time() - stored < self.ttl
+
+    def set(self, key, body, etag=None, last_modified=None):
+        """ Store a response body, evicting old entries as needed. """
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (body, etag, last_modified, time())
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+    def invalidate(self, path, recursive=True):
+        """ Drop the entries for `path` with any query string and, if
+        `recursive` is set, those for all paths below it. """
+        prefixes = (path + '?', path + '/') if recursive else (path + '?',)
+        with self._lock:
+            for key in self._entries.keys():
+                if key[1] == path or key[1].startswith(prefixes):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<ResponseCache(%s entries, %s bytes)>" % (len(self),
+                                                         self._size)
+
 
 class _Base(object):
     """ Common base object for ``Database`` and ``Table``. Does basic
@@ -131,56 +1589,229 @@ class _Base(object):
 
     def __init__(self, server, port, base_path, http_user=None,
             http_password=None,
-            http_apikey=None):
+            http_apikey=None, pool=None, compress_threshold=None,
+            cache=None, retry=None, hooks=None, stats=None, transport=None,
+            codec=None):
         self.server = server
         self.port = port or 80
         self.base_path = base_path
+        self.compress_threshold = compress_threshold
+        self.cache = cache
+        self.retry = retry
+        self.hooks = hooks if hooks is not None else \
+            {'before_request': [], 'after_request': []}
+        self.stats = stats
+        self.codec = codec or get_codec()
+        self.transport = transport or pool or \
+            ConnectionPool(self.server, self.port)
+        # the name used before transports could be exchanged.
+        self.pool = self.transport
         self.authorization = None
         if http_user is not None and http_password is not None:
             secret = http_user + ':' + http_password
-            self.authorization = 'Basic ' + secret.encode('base64')
+            self.authorization = 'Basic ' + b64encode(secret)
         elif http_apikey:
             self.authorization = http_apikey
 
-    def _raw_request(self, method, path, data=None, headers={}):
-        """ Run a raw request, handle authentication but no
-        decoding/encoding. """
-        _headers = {}
+    def _prepare(self, path, data=None, headers={}):
+        """ Resolve `path` against the base path, compress large bodies 
+        and add authentication, encoding and content length headers. """
+        _headers = {'Accept-Encoding': 'gzip, deflate'}
         if self.authorization:
             _headers['Authorization'] = self.authorization
         _headers.update(headers)
         path = urljoin(self.base_path, path)
-        # HACK!! See issue #6. For some reason introduction of Basic Auth
-        # requires +2 on content length
-        if self.authorization and self.authorization.startswith('Basic'):
-            _headers['Content-Length'] = len(data)+2 if data else 0
-        else:
-            _headers['Content-Length'] = len(data) if data else 0
-        conn = HTTPConnection(self.server, self.port)
-        conn.request(method, path, data, _headers)
-        response = conn.getresponse()
+        if data is not None and not isinstance(data, basestring):
+            if self.compress_threshold is not None:
+                data = _gzip_chunks(data)
+                _headers['Content-Encoding'] = 'gzip'
+            _headers['Transfer-Encoding'] = 'chunked'
+            return path, data, _headers
+        if data and self.compress_threshold is not None and \
+                len(data) >= self.compress_threshold:
+            data = _gzip(data)
+            _headers['Content-Encoding'] = 'gzip'
+        _headers['Content-Length'] = len(data) if data else 0
+        return path, data, _headers
+
+    def _raw_request(self, method, path, data=None, headers={}):
+        """ Run a raw request, handle authentication but no
+        decoding/encoding. """
+        path, data, headers = self._prepare(path, data, headers)
+        for hook in self.hooks['before_request']:
+            hook(method, path, headers)
+        if self.stats is None and not self.hooks['after_request']:
+            return self.transport.request(method, path, data, headers)
+        sent = [len(data) if isinstance(data, basestring) else 0]
+        if data is not None and not isinstance(data, basestring):
+            data = _counted_iter(data, sent)
+        started = time()
+        try:
+            response = self.transport.request(method, path, data, headers)
+        except Exception, e:
+            self._after_request(method, path, None, started, sent[0], 0, e)
+            raise
+
+        def _finished(response):
+            self._after_request(method, path, response.status, started,
+                                sent[0], response.received)
+        response.on_close = _finished
         return response
 
-    def _request(self, method, path, data=None, headers={}):
-        """ Run a request against the webstore, using JSON as a 
-        default representation. """
+    def _after_request(self, method, path, status, started, sent, received,
+                       error=None):
+        """ Report a finished request to the stats and hooks. """
+        info = {'method': method, 'path': path,
+                'endpoint': self._endpoint(method, path), 'status': status,
+                'elapsed': time() - started, 'sent': sent,
+                'received': received, 'error': error}
+        if self.stats is not None:
+            self.stats.record_request(info['endpoint'], status,
+                                      info['elapsed'], sent, received)
+        for hook in self.hooks['after_request']:
+            hook(info)
+
+    def _endpoint(self, method, path):
+        """ Name the kind of resource `path` refers to, without the 
+        names of the user, database or table. """
+        parts = urlparse(path).path.strip('/').split('/')[2:]
+        if not len(parts):
+            return method + ' database'
+        return ' '.join([method] + ['table'] + parts[1:2])
+
+    def _timed(self, kind, func, *args):
+        """ Call `func`, recording the time it takes as `kind`. """
+        if self.stats is None:
+            return func(*args)
+        started = time()
+        try:
+            return func(*args)
+        finally:
+            self.stats.record_time(kind, time() - started)
+
+    def _encode(self, data=None, headers={}):
+        """ Encode `data` as JSON unless a content type is given or it
+        is ``RawJSON``. """
         _headers = headers.copy()
         if not 'Content-Type' in _headers:
             _headers['Content-Type'] = 'application/json'
-            if data is not None:
-                data = dumps(data)
+            if data is not None and not isinstance(data, RawJSON):
+                data = self._timed('encode', self.codec.dumps, data)
         if not 'Accept' in _headers:
             _headers['Accept'] = 'application/json'
-        response = self._raw_request(method, path, data, _headers)
+        return data, _headers
+
+    def _request(self, method, path, data=None, headers={}, retry=None):
+        """ Run a request against the webstore, using JSON as a 
+        default representation. GET requests, and others if `retry` is
+        set, are retried according to the retry policy. """
+        data, headers = self._encode(data, headers)
+        if retry is None:
+            retry = method == 'GET'
+        if retry:
+            return self._retrying(self._send, method, path, data, headers)
+        return self._send(method, path, data, headers)
+
+    def _retrying(self, func, *args, **kwargs):
+        """ Call `func`, retrying it according to the retry policy. """
+        if self.retry is None:
+            return func(*args, **kwargs)
+        return self.retry.call(func, _on_retry=self._record_retry, *args,
+                               **kwargs)
+
+    def _retry_wait(self, exc, attempt, started):
+        """ Wait before retrying after `exc`, if the retry policy 
+        allows it. """
+        if self.retry is None or not self.retry.wait(exc, attempt, started):
+            return False
+        self._record_retry(exc)
+        return True
+
+    def _record_retry(self, exc):
+        if self.stats is not None:
+            self.stats.record_retry()
+
+    def _send(self, method, path, data, headers):
+        if method == 'GET' and self.cache is not None:
+            return self._cached_request(path, headers)
+        response = self._raw_request(method, path, data, headers)
+        return self._decode(response)
+
+    def _cached_request(self, path, headers):
+        """ Run a GET request through the response cache. """
+        key = ('GET', urljoin(self.base_path, path))
+        entry = self.cache.get(key)
+        if entry is not None:
+            body, etag, last_modified, fresh = entry
+            if fresh:
+                return self._timed('decode', self.codec.loads, body)
+            headers = headers.copy()
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+        response = self._raw_request('GET', path, None, headers)
+        if response.status == 304 and entry is not None:
+            self._read(response)
+            self.cache.set(key, body, etag, last_modified)
+            return self._timed('decode', self.codec.loads, body)
+        body = self._read(response)
+        data = self._decode(response, body)
+        if response.status == 200:
+            self.cache.set(key, body, response.getheader('ETag'),
+                           response.getheader('Last-Modified'))
+        return data
+
+    def _invalidate(self, path, recursive=True):
+        """ Drop cached responses after a change to `path`. """
+        if self.cache is not None:
+            self.cache.invalidate(path, recursive)
+
+    def _read(self, response):
+        """ Read and decompress the body of a response. """
         try:
-            data = response.read()
-            data = loads(data)
-        except ValueError:
+            body = response.read()
+        finally:
+            response.close()
+        decompressor = _decompressor(response.getheader('Content-Encoding'))
+        if decompressor is not None:
+            body = decompressor.decompress(body) + decompressor.flush()
+        return body
+
+    def _decode(self, response, body=None):
+        """ Decode a JSON response, raising webstore errors. """
+        try:
+            if body is None:
+                body = self._read(response)
+            data = self._timed('decode', self.codec.loads, body)
+        except (ValueError, zlib.error):
             data = {'state': 'error', 'message': response.reason}
         if isinstance(data, dict) and 'state' in data and 'message' in data:
             raise WebstoreClientException(response, data)
         return data
 
+    def _stream(self, method, path, key='data', decoder=None):
+        """ Run a request and decode the array stored under `key` in
+        the JSON response incrementally, yielding each element as soon
+        as it has been read from the socket. """
+        headers = {'Accept': 'application/json'}
+        response = self._raw_request(method, path, None, headers)
+        try:
+            if response.status >= 300:
+                self._decode(response)
+                return
+            body = response
+            decompressor = _decompressor(
+                response.getheader('Content-Encoding'))
+            if decompressor is not None:
+                body = _DecompressingReader(response, decompressor)
+            for item in _stream_array(body, key, decoder):
+                yield item
+            while response.read(CHUNK_SIZE):
+                pass
+        finally:
+            response.close()
+
 
 class Database(_Base):
     """ A web-based database with many `Tables`. Databases are owned by 
@@ -188,7 +1819,10 @@ class Database(_Base):
 
     def __init__(self, server, database_user, database_name, 
             port=None, http_user=None, http_password=None,
-            http_apikey=None, attach=[]):
+            http_apikey=None, attach=[], pool=None,
+            compress_threshold=None, cache=None, catalog_ttl=None,
+            retry=None, hooks=None, stats=None, transport=None,
+            codec=None):
         """ Create a new database connection to the server `server_url`.
 
         This will create an object that allows the creation and management
@@ -209,6 +1843,37 @@ class Database(_Base):
             - `http_password`: the user's password.
             - `http_apikey`: API Key e.g. for CKAN.
             - `attach`: A list of other databases to attach.
+            - `pool`: a ``ConnectionPool`` to share keep-alive
+              connections with other handles. A new pool is created
+              if none is given.
+            - `compress_threshold`: gzip request bodies of at least this
+              many bytes. Only use this if the server accepts compressed
+              requests. Responses are always decompressed transparently.
+            - `cache`: a ``ResponseCache`` for GET requests, shared with
+              the tables of this database.
+            - `catalog_ttl`: keep the list of tables for this many seconds,
+              so that `__contains__` is answered locally. Tables created
+              or deleted through this handle update the list right away.
+            - `retry`: a ``RetryPolicy`` for failed requests, shared with
+              the tables of this database. Failed requests are not
+              retried if none is given.
+            - `hooks`: a dictionary of lists of callbacks, shared with the
+              tables of this database. Callbacks in ``before_request`` are
+              called with the method, path and headers of each request 
+              and may change the headers. Callbacks in ``after_request``
+              are called with a dictionary describing the finished 
+              request: its `method`, `path`, `endpoint`, `status`, the
+              `elapsed` seconds, the bytes `sent` and `received` and the
+              `error` raised, if any.
+            - `stats`: a ``ClientStats`` collector for the requests of this
+              database and its tables.
+            - `transport`: the ``Transport`` that runs requests, shared 
+              with the tables of this database, e.g. a 
+              ``SocketTransport`` or a ``WSGITransport``. Defaults to
+              `pool`.
+            - `codec`: the ``JSONCodec`` used to encode and decode 
+              bodies, see ``get_codec``. Defaults to ``get_codec()``,
+              which decodes with ``ujson`` if it is installed.
         """
         self.database_user = database_user
         self.database_name = database_name
@@ -216,21 +1881,90 @@ class Database(_Base):
         self.http_password = http_password
         self.http_apikey = http_apikey
         self.attach = attach
+        self.catalog_ttl = catalog_ttl
+        self._catalog = None
+        self._catalog_version = 0
+        self._catalog_lock = Lock()
         assert not '/' in server, "Server hostname most not contain '/'!"
         base_path = '/' + database_user + '/' + database_name
         super(Database, self).__init__(server, port, base_path,
-                http_user, http_password, http_apikey)
+                http_user, http_password, http_apikey, pool,
+                compress_threshold, cache, retry, hooks, stats, transport,
+                codec)
 
-    def query(self, query):
+    def query(self, query, params=None):
         """ Run a raw SQL query against the webstore. If the user has rights
         to delete entries, this can be any SQL statement, otherwise it may only
-        be a read-only query. """
+        be a read-only query. 
+
+        :Parameters:
+            - `query`: the SQL statement to run.
+            - `params`: an optional list of values to bind to ``?``
+              placeholders in the statement.
+        """
         payload = {
             "query": query,
             "attach": self.attach
             }
-        return self._request("PUT", '', data=dumps(payload),
-                             headers={'Content-Type': 'application/json'})
+        if params is not None:
+            payload['params'] = params
+        return self._request("PUT", '', data=payload)
+
+    def query_many(self, queries, concurrency=4, timeout=None, stream=False):
+        """ Run several independent SQL queries in parallel over pooled
+        connections. A query that fails does not affect the others: its 
+        result is the exception it raised.
+
+        :Parameters:
+            - `queries`: a list of SQL statements or of (statement, params)
+              tuples.
+            - `concurrency`: the number of queries to run at the same time.
+            - `timeout`: the number of seconds to wait for all queries.
+              Queries that have not finished by then get a 
+              ``socket.timeout`` as their result.
+            - `stream`: instead of a list of results in the order of
+              `queries`, return a generator of (index, result) tuples in 
+              the order in which the queries finish.
+        """
+        results = self._query_many(queries, concurrency, timeout)
+        if stream:
+            return results
+        ordered = [None] * len(queries)
+        for index, result in results:
+            ordered[index] = result
+        return ordered
+
+    def _query_many(self, queries, concurrency, timeout):
+        done = Queue()
+
+        def _run(index, query):
+            try:
+                if isinstance(query, basestring):
+                    done.put((index, self.query(query)))
+                else:
+                    done.put((index, self.query(*query)))
+            except Exception, e:
+                done.put((index, e))
+        pool = _WorkerPool(min(concurrency, len(queries)))
+        try:
+            for index, query in enumerate(queries):
+                pool.submit(_run, index, query)
+            pending = set(range(len(queries)))
+            deadline = None if timeout is None else time() + timeout
+            while pending:
+                wait = None if deadline is None else deadline - time()
+                try:
+                    if wait is not None and wait <= 0:
+                        raise Empty()
+                    index, result = done.get(timeout=wait)
+                except Empty:
+                    break
+                pending.discard(index)
+                yield index, result
+            for index in sorted(pending):
+                yield index, socket.timeout('Query timed out.')
+        finally:
+            pool.shutdown()
 
     def __contains__(self, table_name):
         """ Check if `table_name` is an existing table on the database. 
@@ -238,12 +1972,55 @@ class Database(_Base):
         :Parameters:
             - `table_name`: the table name to check for.
         """
-        return table_name in self.tables()
+        if self.catalog_ttl is None:
+            return table_name in self.tables()
+        return table_name in self._fetch_catalog()[1]
+
+    def tables(self, refresh=False):
+        """ Get a list of the tables defined in this database. 
+
+        :Parameters:
+            - `refresh`: fetch the list from the server even if a cached
+              list is still fresh (see `catalog_ttl`).
+        """
+        if self.catalog_ttl is None:
+            response = self._request("GET", '')
+            return [r.get('name') for r in response['data']]
+        return list(self._fetch_catalog(refresh)[0])
 
-    def tables(self):
-        """ Get a list of the tables defined in this database. """
+    def _fetch_catalog(self, refresh=False):
+        """ Get the cached list of tables as a tuple of (names, set of
+        names, time fetched), fetching it again once it has expired. """
+        catalog = self._catalog
+        if catalog is not None and not refresh and \
+                time() - catalog[2] < self.catalog_ttl:
+            return catalog
+        with self._catalog_lock:
+            version = self._catalog_version
         response = self._request("GET", '')
-        return [r.get('name') for r in response['data']]
+        names = [r.get('name') for r in response['data']]
+        catalog = (names, set(names), time())
+        with self._catalog_lock:
+            # a table created or deleted during the request may be
+            # missing from the list, which must not replace the update.
+            if self._catalog_version == version:
+                self._catalog = catalog
+        return catalog
+
+    def _catalog_update(self, table_name, exists):
+        """ Record the creation or deletion of a table in the cached
+        list of tables, if there is one. """
+        with self._catalog_lock:
+            self._catalog_version += 1
+            if self._catalog is None:
+                return
+            names, known, fetched = self._catalog
+            if exists and table_name not in known:
+                self._catalog = (names + [table_name],
+                                 known | set([table_name]), fetched)
+            elif not exists and table_name in known:
+                self._catalog = ([n for n in names if n != table_name],
+                                 known - set([table_name]), fetched)
 
     def __getitem__(self, table_name):
         """ Get a table from the database by name. 
@@ -252,7 +2029,9 @@ class Database(_Base):
             - `table_name`: name of the table to return.
         """
         return Table(self.server, self.port, self.base_path, table_name,
-                     self.http_user, self.http_password, self.http_apikey)
+                     self.http_user, self.http_password, self.http_apikey,
+                     transport=self.transport, database=self,
+                     compress_threshold=self.compress_threshold)
 
     def __repr__(self):
         return "<Database(%s / %s)>" % (self.database_user,
@@ -264,7 +2043,10 @@ class Table(_Base):
     and (if authorized) write operations. """
 
     def __init__(self, server, port, base_path, table_name, http_user=None,
-                 http_password=None, http_apikey=None):
+                 http_password=None, http_apikey=None, pool=None,
+                 database=None, compress_threshold=None, cache=None,
+                 retry=None, hooks=None, stats=None, transport=None,
+                 codec=None):
         """ Get a handle for the table `table_name` on `server`.
 
         *Note*: This is usually created via database[table_name].
@@ -287,16 +2069,174 @@ class Table(_Base):
             - `http_user`: the username for HTTP authentication.
             - `http_password`: the user's password.
             - `http_apikey`: API Key e.g. for CKAN.
+            - `pool`: a ``ConnectionPool`` to share keep-alive
+              connections with other handles.
+            - `database`: the ``Database`` this table belongs to, used to
+              run SQL queries. A handle is created from `base_path` if 
+              none is given.
+            - `compress_threshold`: gzip request bodies of at least this
+              many bytes.
+            - `cache`: a ``ResponseCache`` for GET requests. If a 
+              `database` is given, its cache is used instead.
+            - `retry`: a ``RetryPolicy`` for failed requests. If a 
+              `database` is given, its policy is used instead.
+            - `hooks`, `stats`: request callbacks and a ``ClientStats``
+              collector, see ``Database``. If a `database` is given, its
+              own are used instead.
+            - `transport`: the ``Transport`` that runs requests, defaults
+              to `pool`. If a `database` is given, its transport is used
+              instead.
+            - `codec`: the ``JSONCodec`` for bodies. If a `database` is
+              given, its codec is used instead.
         """
         self.table_name = table_name
         self.unique_columns = []
+        if database is None:
+            database_user, database_name = base_path.strip('/').split('/')
+            database = Database(server, database_user, database_name,
+                                port=port, http_user=http_user,
+                                http_password=http_password,
+                                http_apikey=http_apikey, pool=pool,
+                                compress_threshold=compress_threshold,
+                                cache=cache, retry=retry, hooks=hooks,
+                                stats=stats, transport=transport,
+                                codec=codec)
+        self.database = database
         base_path = base_path + '/' + table_name
         self._buffer = defaultdict(list)
+        self._writer = None
+        self.row_factory = None
         super(Table, self).__init__(server, port, base_path,
-                http_user, http_password, http_apikey)
+                http_user, http_password, http_apikey, None,
+                compress_threshold, database.cache, database.retry,
+                database.hooks, database.stats, database.transport,
+                database.codec)
+
+    def _fetch_page(self, query, offset, limit, stream=False, decoder=None):
+        """ Fetch a single page of rows. When `stream` is set, a 
+        generator decoding the rows as they arrive is returned. """
+        if stream:
+            return self._stream_page(query, offset, limit, decoder)
+        return self._request("GET", _page_path(query, offset, limit))['data']
+
+    def _fetch_sized(self, path):
+        """ Fetch a page, returning its rows and the size of the body. """
+        response = self._raw_request("GET", path, None,
+                                     {'Accept': 'application/json'})
+        body = self._read(response)
+        return self._decode(response, body)['data'], len(body)
+
+    def _adaptive_pages(self, query, sizer, step, limit, offset):
+        """ Fetch pages whose size is adapted by `sizer` to how long 
+        each page took and how large it was. """
+        step = max(sizer.min_step, min(sizer.max_step, step))
+        while limit is None or limit > 0:
+            page = step if limit is None else min(step, limit)
+            started = time()
+            rows, size = self._retrying(self._fetch_sized,
+                                        _page_path(query, offset, page))
+            # measured before yielding, so time the caller spends on
+            # the rows does not count as page latency.
+            elapsed = time() - started
+            yield page, rows
+            step = sizer.next_step(page, len(rows), elapsed, size)
+            offset += len(rows)
+            if limit is not None:
+                limit -= len(rows)
+
+    def _stream_page(self, query, offset, limit, decoder=None):
+        """ Stream a single page of rows. If the connection fails part
+        way and the retry policy allows it, the rest of the page is 
+        requested again, starting after the last row received. """
+        done, attempt, started = 0, 0, time()
+        while True:
+            try:
+                for row in self._stream("GET", _page_path(query,
+                        offset + done, limit - done), decoder=decoder):
+                    done += 1
+                    yield row
+                return
+            except Exception, e:
+                if not self._retry_wait(e, attempt, started):
+                    raise
+                attempt += 1
+
+    def _prefetch_pages(self, query, windows, prefetch, workers):
+        """ Fetch the pages for `windows` on a pool of worker threads,
+        keeping at most `prefetch` pages ahead of the one that is
+        being consumed. Pages are yielded in order. """
+        pool = _WorkerPool(workers)
+        pending = deque()
+        try:
+            for offset, limit in windows:
+                future = pool.submit(self._fetch_page, query, offset, limit)
+                pending.append((limit, future))
+                if len(pending) > prefetch:
+                    limit, future = pending.popleft()
+                    yield limit, future.result()
+            while pending:
+                limit, future = pending.popleft()
+                yield limit, future.result()
+        finally:
+            pool.shutdown()
+
+    def _select(self, columns):
+        """ Start an SQL query for `columns`, or all columns. """
+        if columns:
+            columns = ', '.join(map(_quote_identifier, columns))
+        return 'SELECT %s FROM %s' % (columns or '*',
+                                      _quote_identifier(self.table_name))
+
+    def _sql_pages(self, columns, where, sort, windows, filters):
+        """ Fetch pages with SQL queries, selecting only `columns` from
+        the rows that match `where` as well as the `filters`. """
+        sql = self._select(columns)
+        conditions, params = _filter_clause(filters, where)
+        if len(conditions):
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        order = ['%s %s' % (_quote_identifier(c),
+                            'DESC' if d == DESCENDING else 'ASC')
+                 for c, d in sort]
+        # the row id keeps the order of the pages stable.
+        sql += ' ORDER BY ' + ', '.join(order + ['"__id__" ASC'])
+        for offset, limit in windows:
+            page_sql = sql + ' LIMIT %d OFFSET %d' % (limit, offset)
+            yield limit, self._retrying(self.database.query, page_sql,
+                                        params)['data']
+
+    def _keyset_pages(self, key, step, limit, filters, columns=None,
+                      where=None):
+        """ Fetch pages ordered by the unique column `key`, asking each
+        time for the rows after the last key seen instead of using an
+        ever-growing offset. """
+        column = _quote_identifier(key)
+        if columns and key not in columns:
+            columns = list(columns) + [key]
+        sql = self._select(columns)
+        last = None
+        while limit is None or limit > 0:
+            page = step if limit is None else min(step, limit)
+            where_sql, params = _filter_clause(filters, where)
+            if last is not None:
+                where_sql.append('%s > ?' % column)
+                params.append(last)
+            page_sql = sql
+            if len(where_sql):
+                page_sql += ' WHERE ' + ' AND '.join(where_sql)
+            page_sql += ' ORDER BY %s ASC LIMIT %d' % (column, page)
+            rows = self._retrying(self.database.query, page_sql,
+                                  params)['data']
+            yield page, rows
+            if not len(rows):
+                break
+            last = rows[-1][key]
+            if limit is not None:
+                limit -= len(rows)
 
     def traverse(self, _step=1000, _sort=[], _limit=None, _offset=0, 
-                 **kwargs):
+                 _prefetch=0, _workers=None, _keyset=None, _stream=False,
+                 _row_factory=None, _adaptive=None, _where=None,
+                 _columns=None, **kwargs):
         """ Iterate over the table, fetching `_step` items at a time.
 
         This will return a generator to traverse the table and yield each
@@ -310,25 +2250,233 @@ class Table(_Base):
             - `_sort`: a list of sorting parameters given as tuples of 
               (column, direction). The `direction` can either be 'asc' or
               'desc'.
+            - `_prefetch`: the number of pages to fetch ahead in the
+              background while the current page is being consumed. 
+              Rows are still yielded in order.
+            - `_workers`: the number of threads used to prefetch pages,
+              defaults to `_prefetch`.
+            - `_keyset`: name of a unique, sortable column (e.g. the
+              implicit row id ``__id__``). When given, rows are returned
+              in the order of that column and each page asks for the rows
+              after the last key seen, so that deep pages are as cheap as
+              the first. Cannot be combined with `_sort`, `_offset` or
+              `_prefetch`.
+            - `_stream`: decode each page incrementally while it is read
+              from the socket, so that the first rows are yielded before 
+              the page has been received and memory use does not grow
+              with `_step`. Cannot be combined with `_keyset` or
+              `_prefetch`.
+            - `_row_factory`: a callable creating each row from a tuple of
+              column names, shared by all rows with the same columns, and a
+              tuple of values, e.g. ``Row``. Defaults to the `row_factory`
+              of the table; if both are ``None``, rows are dictionaries.
+            - `_adaptive`: ``True`` or a ``PageSizer`` to adapt the page
+              size to the table while traversing it, starting at `_step`.
+              Cannot be combined with `_keyset`, `_prefetch` or `_stream`.
+            - `_where`: an ``Expression`` the rows must match, e.g.
+              ``(col('temp') > 10) & col('place').in_(['Berlin', 'Rome'])``.
+            - `_columns`: a list of the columns to fetch, instead of all
+              of them. With `_keyset`, the key column is always fetched.
             - other keyword arguments: will be passed to the server and 
               treated as column filters. 
+
+        With `_where` or `_columns`, the pages are fetched with SQL
+        queries so that only the matching rows and the selected columns
+        are transferred. This cannot be combined with `_prefetch`, 
+        `_stream` or `_adaptive`.
+
+        With a ``RetryPolicy``, a page that fails to load is requested
+        again, so the traversal continues where it stopped.
         """
-        if _limit is not None:
-            _step = min(_step, _limit)
-        query = kwargs.items()
-        query.extend([('_sort', '%s:%s' % (v, k)) for k, v in _sort])
-        while _limit is None or _offset < _limit:
-            page_query = list(query)
-            page_query.append(('_offset', _offset))
-            page_query.append(('_limit', _step))
-            qs = urlencode([(k, unicode(v).encode('utf-8')) for \
-                            k, v in page_query])
-            result = self._request("GET", '?' + qs)
-            for row in result['data']:
-                yield row
-            if len(result) < _step:
+        query = _traverse_query(_sort, kwargs)
+        windows = _page_windows(_step, _limit, _offset)
+        row_factory = _row_factory or self.row_factory
+        builder = _RowBuilder(row_factory) if row_factory else None
+        decoder = None
+        if builder is not None and _stream:
+            decoder = JSONDecoder(object_pairs_hook=builder)
+        convert = builder is not None and decoder is None
+        if _stream and (_keyset is not None or _prefetch):
+            raise ValueError("Streaming cannot be combined with _keyset "
+                             "or _prefetch.")
+        if _adaptive and (_keyset is not None or _prefetch or _stream):
+            raise ValueError("Adaptive page sizes cannot be combined with "
+                             "_keyset, _prefetch or _stream.")
+        sql = _where is not None or _columns is not None
+        if sql and (_prefetch or _stream or _adaptive):
+            raise ValueError("_where and _columns cannot be combined with "
+                             "_prefetch, _stream or _adaptive.")
+        if _adaptive:
+            sizer = _adaptive if isinstance(_adaptive, PageSizer) \
+                else PageSizer()
+            pages = self._adaptive_pages(query, sizer, _step, _limit,
+                                         _offset)
+        elif _keyset is not None:
+            if _sort or _offset or _prefetch:
+                raise ValueError("Keyset traversal cannot be combined "
+                                 "with _sort, _offset or _prefetch.")
+            pages = self._keyset_pages(_keyset, _step, _limit,
+                                       kwargs.items(), _columns, _where)
+        elif sql:
+            pages = self._sql_pages(_columns, _where, _sort, windows,
+                                    kwargs.items())
+        elif _prefetch:
+            pages = self._prefetch_pages(query, windows, _prefetch,
+                                         _workers or _prefetch)
+        else:
+            pages = ((l, self._fetch_page(query, o, l, stream=_stream,
+                                          decoder=decoder)) \
+                     for o, l in windows)
+        try:
+            for limit, rows in pages:
+                count = 0
+                for row in rows:
+                    count += 1
+                    yield builder.from_dict(row) if convert else row
+                if count < limit:
+                    break
+        finally:
+            pages.close()
+
+    def fetch_columns(self, columns=None, dtype_map=None, as_numpy=False,
+                      as_records=False, _step=1000, _sort=[], _limit=None,
+                      _offset=0, **kwargs):
+        """ Fetch the table into one buffer per column instead of one
+        dictionary per row. Rows are decoded from the response straight
+        into the column buffers, one page at a time, which takes a 
+        fraction of the memory of a list of rows::
+
+          >>> columns = table.fetch_columns(['place', 'temp'],
+                                            dtype_map={'temp': 'd'})
+          >>> sum(columns['temp']) / len(columns['temp'])
+
+        :Parameters:
+            - `columns`: the names of the columns to fetch, defaults to
+              all the columns of the first row.
+            - `dtype_map`: a dictionary of column names to ``array`` type
+              codes, e.g. ``'d'`` for floats or ``'l'`` for integers. 
+              These columns are returned as typed ``array.array`` 
+              objects, with ``NULL`` stored as ``nan`` in float columns.
+              All other columns are returned as lists.
+            - `as_numpy`: return NumPy arrays (requires NumPy).
+            - `as_records`: return a single NumPy record array with one
+              field per column (requires NumPy).
+            - `_step`, `_sort`, `_limit`, `_offset` and other keyword
+              arguments: see `traverse`.
+        """
+        dtype_map = dtype_map or {}
+        buffers = OrderedDict()
+        appenders = {}
+        state = {'rows': 0}
+
+        def _add_column(name):
+            if name in dtype_map:
+                buffers[name] = array.array(dtype_map[name])
+            else:
+                buffers[name] = []
+            appenders[name] = _column_appender(name, buffers[name])
+
+        def _add_row(pairs):
+            if not len(buffers):
+                for name in columns or [k for k, v in pairs]:
+                    _add_column(name)
+            filled = 0
+            for name, value in pairs:
+                append = appenders.get(name)
+                if append is not None:
+                    append(value)
+                    filled += 1
+            state['rows'] += 1
+            if filled < len(buffers):
+                for name, buf in buffers.items():
+                    if len(buf) < state['rows']:
+                        appenders[name](None)
+        for name in columns or []:
+            _add_column(name)
+        decoder = JSONDecoder(object_pairs_hook=_add_row)
+        query = _traverse_query(_sort, kwargs)
+        for offset, limit in _page_windows(_step, _limit, _offset):
+            before = state['rows']
+            for row in self._stream_page(query, offset, limit, decoder):
+                pass
+            if state['rows'] - before < limit:
                 break
-            _offset += _step
+        if not as_numpy and not as_records:
+            return buffers
+        try:
+            import numpy
+        except ImportError:
+            raise ValueError("NumPy is required for as_numpy/as_records.")
+        arrays = OrderedDict()
+        for name, buf in buffers.items():
+            if isinstance(buf, list):
+                arrays[name] = numpy.array(buf, dtype=object)
+            elif buf.typecode in _NUMPY_CHARS:
+                # in NumPy, 'u' is an unsigned integer, not a character.
+                arrays[name] = numpy.array(buf.tolist(),
+                                           dtype=_NUMPY_CHARS[buf.typecode])
+            else:
+                arrays[name] = numpy.frombuffer(buf, dtype=buf.typecode)
+        if as_records:
+            return numpy.rec.fromarrays(arrays.values(),
+                                        names=[str(n) for n in arrays])
+        return arrays
+
+    def count(self, _where=None, **kwargs):
+        """ Count the rows in the table, or those whose columns have the 
+        values given as keyword arguments and that match the 
+        ``Expression`` `_where`, if given. The rows are counted by the 
+        server, so that only the number is transferred. """
+        where, params = _filter_clause(kwargs.items(), _where)
+        sql = 'SELECT COUNT(*) AS "count" FROM ' + \
+            _quote_identifier(self.table_name)
+        if len(where):
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self._retrying(self.database.query, sql,
+                              params)['data'][0]['count']
+
+    def aggregate(self, aggregates, group_by=None, _where=None, **kwargs):
+        """ Compute aggregates over the table on the server, e.g. 
+        ``table.aggregate({'temp': ['min', 'max']}, group_by=['place'])``.
+        Each aggregate is returned in a column named after the function
+        and the column, e.g. ``max_temp``.
+
+        :Parameters:
+            - `aggregates`: a dictionary of column names to one or a list 
+              of 'sum', 'min', 'max', 'avg' or 'count'.
+            - `group_by`: a list of columns to compute the aggregates for
+              each distinct combination of. A list of rows with these
+              columns and the aggregates is returned, ordered by them.
+              Without it, a single row is returned.
+            - `_where`: only aggregate the rows matching this 
+              ``Expression``.
+            - other keyword arguments: only aggregate the rows whose 
+              columns have these values.
+        """
+        columns = []
+        for column in group_by or []:
+            columns.append(_quote_identifier(column))
+        for column, functions in sorted(aggregates.items()):
+            if isinstance(functions, basestring):
+                functions = [functions]
+            for function in functions:
+                if function not in AGGREGATES:
+                    raise ValueError("Unknown aggregate: %s" % function)
+                columns.append('%s(%s) AS %s' % (AGGREGATES[function],
+                    _quote_identifier(column),
+                    _quote_identifier(function + '_' + column)))
+        if not len(columns):
+            raise ValueError("No aggregates given.")
+        where, params = _filter_clause(kwargs.items(), _where)
+        sql = 'SELECT %s FROM %s' % (', '.join(columns),
+                                     _quote_identifier(self.table_name))
+        if len(where):
+            sql += ' WHERE ' + ' AND '.join(where)
+        if group_by:
+            groups = ', '.join(map(_quote_identifier, group_by))
+            sql += ' GROUP BY %s ORDER BY %s' % (groups, groups)
+        rows = self._retrying(self.database.query, sql, params)['data']
+        return rows if group_by else rows[0]
 
     def find_one(self, **kwargs):
         """ Get a single item matching the given criteria. The criteria 
@@ -342,6 +2490,71 @@ class Table(_Base):
         except WebstoreClientException:
             return None
 
+    def load_file(self, path, format=None, unique_columns=None, types=None,
+                  encoding='utf-8', delimiter=',', chunk_rows=BATCH_ROWS,
+                  chunk_bytes=BATCH_BYTES, workers=2):
+        """ Load the rows of a CSV or JSON lines file into the table. The
+        file is read a line at a time while earlier chunks are being 
+        uploaded, with a bounded number of chunks in flight, so memory
+        use does not depend on the size of the file::
+
+          table.load_file('export.csv.gz', types={'temp': float})
+
+        Returns the number of rows loaded. If chunks fail to upload, a
+        ``WebstoreWriteError`` is raised as for `writerows`.
+
+        :Parameters:
+            - `path`: the file to load, which may be gzip-compressed if
+              its name ends in ``.gz``.
+            - `format`: ``'csv'`` or ``'jsonl'``, guessed from the file
+              name if not given. CSV files need a header line.
+            - `unique_columns`: see `writerows`.
+            - `types`: a dictionary of column names to functions that
+              convert their values, e.g. ``int``. Empty values become
+              ``None``.
+            - `encoding`: the character encoding of the file.
+            - `delimiter`: the field delimiter of a CSV file.
+            - `chunk_rows`, `chunk_bytes`: see `writerows`.
+            - `workers`: the number of chunks uploaded in parallel while
+              the file is being read.
+        """
+        name = path[:-3] if path.endswith('.gz') else path
+        if format is None:
+            format = os.path.splitext(name)[1].lstrip('.').lower()
+            format = {'json': 'jsonl', 'ndjson': 'jsonl'}.get(format, format)
+        if format not in ('csv', 'jsonl'):
+            raise ValueError("Unknown file format: %s" % format)
+        opener = gzip.open if path.endswith('.gz') else open
+        count = [0]
+        with opener(path, 'rb') as fh:
+            if format == 'csv':
+                rows = _read_csv(fh, encoding, delimiter)
+            else:
+                rows = _read_jsonl(fh, encoding, self.codec.loads)
+            if types:
+                rows = _coerce(rows, types)
+            self._write(_counted_iter(rows, count, 1), unique_columns,
+                        chunk_rows, chunk_bytes, workers, threaded=True)
+        return count[0]
+
+    def mirror(self, path, watermark='__id__', key='__id__', step=10000):
+        """ Copy the table into a local SQLite file and return a 
+        ``Mirror`` to read it, which can later `sync` the rows that were
+        added or changed since. An existing copy in the file is synced
+        rather than fetched again.
+
+        :Parameters:
+            - `path`: the SQLite file to store the copy in.
+            - `watermark`: a column whose value grows when a row is added
+              or changed, e.g. a modification time. The default, the 
+              implicit row id, only finds rows that have been added.
+            - `key`: a unique column identifying each row.
+            - `step`: the number of rows fetched with each request.
+        """
+        mirror = Mirror(self, path, watermark=watermark, key=key, step=step)
+        mirror.sync()
+        return mirror
+
     def writerow(self, row, unique_columns=None, bufferlen=None):
         """ Write a single row. The row is expected to be a flat
         dictionary (i.e. no lists, tuples or dicts as values).
@@ -351,7 +2564,9 @@ class Table(_Base):
         return self.writerows([row], unique_columns=unique_columns,
                               bufferlen=bufferlen)
 
-    def writerows(self, rows, unique_columns=None, bufferlen=None):
+    def writerows(self, rows, unique_columns=None, bufferlen=None,
+                  chunk_rows=BATCH_ROWS, chunk_bytes=BATCH_BYTES, workers=1,
+                  stream=False):
         """ Write a set of rows to the table. Each row is expected to be
         a flat dictionary (i.e. no lists, tuples or dicts as values).
 
@@ -360,13 +2575,42 @@ class Table(_Base):
         set. If no update can be performed, a new row will instead be 
         inserted.
 
+        The rows are encoded one at a time and uploaded in chunks, so 
+        `rows` can be any iterable, including a generator. If there is
+        more than one chunk, a list with the server response for each 
+        chunk is returned. Chunks that fail to upload do not stop the
+        others; a ``WebstoreWriteError`` listing them is raised once all
+        chunks have been sent.
+
+        Rows that are ``RawJSON`` are sent without being encoded again.
+        `rows` can also be a ``RawJSON`` array, which is sent as the
+        body of a single request.
+
+        When a background writer has been started with `start_writer`,
+        the rows are buffered and uploaded by the writer instead.
+
         :Parameters:
-            - `rows`: a list of rows to be written to the table.
+            - `rows`: an iterable of rows to be written to the table.
             - `unique_columns`: a set of columns that can be used to 
               uniquely identify this row when attempting to update.
+            - `bufferlen`: buffer the rows and only write them once this
+              many rows have been collected for the `unique_columns`.
+            - `chunk_rows`: the maximum number of rows per request.
+            - `chunk_bytes`: the maximum size of a request body.
+            - `workers`: the number of chunks to upload in parallel.
+              Chunks written with `unique_columns` are retried according
+              to the retry policy, as writing them twice does no harm.
+            - `stream`: send all rows in a single request instead, 
+              encoding them while they are sent with chunked transfer
+              encoding. Memory use stays constant however many rows
+              `rows` generates. The server must accept chunked requests.
         """
+        if self._writer is not None:
+            self._writer.add(rows, unique_columns or self.unique_columns)
+            return {'state': 'buffered'}
+
         if bufferlen is not None:
-            key = SEP.join(unique_columns)
+            key = SEP.join(unique_columns or [])
             self._buffer[key].extend(rows)
             if len(self._buffer[key]) >= bufferlen:
                 ret = self.writerows(self._buffer[key], 
@@ -374,22 +2618,141 @@ class Table(_Base):
                 self._buffer[key] = list()
                 return ret
             return {'state': 'buffered'}
+        if stream:
+            return self._write_stream(rows, unique_columns)
+        return self._write(rows, unique_columns, chunk_rows, chunk_bytes,
+                           workers)
 
+    def _write_stream(self, rows, unique_columns=None):
+        """ Upload rows in a single request, encoding them on the fly. """
+        unique_columns = unique_columns or self.unique_columns
+        query = '?' + urlencode([('unique', u) for u in unique_columns])
+        body = _json_chunks(rows, dumps=self.codec.dumps)
+        if self.stats is not None:
+            body = _timed_iter(body, self.stats, 'encode')
         try:
-            unique_columns = unique_columns or self.unique_columns
-            query = '?' + urlencode([('unique', u) for u in unique_columns])
-            return self._request("POST", query, rows)
+            result = self._post(query, body)
+        finally:
+            self._invalidate(self.base_path)
+            self._invalidate(self.database.base_path, recursive=False)
+        self.database._catalog_update(self.table_name, True)
+        return result
+
+    def _post(self, query, body, retry=False):
+        """ Upload a JSON-encoded list of rows. """
+        try:
+            return self._request("POST", query, body,
+                                 headers={'Content-Type': 'application/json'},
+                                 retry=retry)
         except WebstoreClientException, wce:
             if wce.state != 'success':
                 raise
 
+    def _write(self, rows, unique_columns=None, chunk_rows=BATCH_ROWS,
+               chunk_bytes=BATCH_BYTES, workers=1, threaded=False):
+        """ Upload rows to the table right away, in chunks of at most
+        `chunk_rows` rows and `chunk_bytes` bytes, running up to 
+        `workers` uploads at once. With a single worker, chunks are 
+        uploaded in the calling thread unless `threaded` is set. """
+        unique_columns = unique_columns or self.unique_columns
+        query = '?' + urlencode([('unique', u) for u in unique_columns])
+        retry = bool(len(unique_columns))
+        results, errors = [], []
+
+        def _collect(index, start, count, future):
+            try:
+                results[index] = future.result()
+            except Exception, e:
+                results[index] = e
+                errors.append((index, start, count, e))
+        pool = _WorkerPool(workers) if workers > 1 or threaded else None
+        in_flight = 0 if pool is None else 2 * workers
+        pending = deque()
+        start = 0
+        if isinstance(rows, RawJSON):
+            batches = [(0, rows)]
+        else:
+            batches = _batches(rows, chunk_rows, chunk_bytes,
+                               self.codec.dumps)
+        if self.stats is not None:
+            batches = _timed_iter(batches, self.stats, 'encode')
+        try:
+            for index, (count, body) in enumerate(batches):
+                results.append(None)
+                if pool is None:
+                    future = _Future.call(self._post, query, body, retry)
+                else:
+                    future = pool.submit(self._post, query, body, retry)
+                pending.append((index, start, count, future))
+                start += count
+                while len(pending) > in_flight:
+                    _collect(*pending.popleft())
+            while pending:
+                _collect(*pending.popleft())
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            self._invalidate(self.base_path)
+            self._invalidate(self.database.base_path, recursive=False)
+        if len(errors) < len(results):
+            self.database._catalog_update(self.table_name, True)
+        if len(results) == 1 and len(errors):
+            raise errors[0][-1]
+        if len(errors):
+            raise WebstoreWriteError(sorted(errors), results)
+        return results[0] if len(results) == 1 else results or None
+
+    def start_writer(self, bufferlen=1000, max_bytes=None, max_age=None,
+                     max_buffered=None):
+        """ Start a background thread that uploads rows written to this
+        table, so that producers do not wait for uploads. Rows are 
+        buffered per set of `unique_columns` and uploaded as soon as one
+        of the limits is reached. Call `flush` to wait for all buffered
+        rows to be written and `close` (or leave a ``with`` block) to 
+        also stop the thread::
+
+          with table.start_writer(bufferlen=500, max_age=5):
+              for row in rows:
+                  table.writerow(row)
+
+        :Parameters:
+            - `bufferlen`: upload once this many rows are buffered.
+            - `max_bytes`: upload once the buffered rows take up this many
+              bytes when encoded as JSON.
+            - `max_age`: upload once the oldest buffered row has waited
+              this many seconds.
+            - `max_buffered`: block writers while this many rows are 
+              buffered or being uploaded.
+        """
+        if self._writer is None:
+            self._writer = _BackgroundWriter(self, bufferlen, max_bytes,
+                                             max_age, max_buffered)
+            self._writer.start()
+        return self
+
     def flush(self):
         """ Flush write buffer. """
+        if self._writer is not None:
+            return self._writer.flush()
         for key, rows in self._buffer.items():
-            unique_columns = key.split(SEP)
+            unique_columns = key.split(SEP) if key else []
             self.writerows(rows, unique_columns=unique_columns)
             self._buffer[key] = []
 
+    def close(self):
+        """ Flush the write buffer and stop the background writer, if
+        one has been started. """
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
     def schema(self, column_name):
         """ Get information about the table layout. """
         return self._request('GET', self.table_name + '/schema')
@@ -399,7 +2762,8 @@ class Table(_Base):
         return self._request('GET', self.table_name + '/distinct/' + column_name)
 
     def __iter__(self):
-        """ Defer iteration to traverse. """
+        """ Defer iteration to traverse. Set `row_factory` (e.g. to 
+        ``Row``) to iterate over compact rows instead of dictionaries. """
         return iter(self.traverse())
 
     def delete(self):
@@ -407,11 +2771,365 @@ class Table(_Base):
         as any contained data.
         """
         try:
-            return self._request("DELETE", '')
+            result = self._request("DELETE", '')
         except WebstoreClientException, wce:
             if wce.state != 'success':
                 raise
+            result = None
+        finally:
+            self._invalidate(self.base_path)
+            self._invalidate(self.database.base_path, recursive=False)
+        self.database._catalog_update(self.table_name, False)
+        return result
 
     def __repr__(self):
         return "<Table(%s)>" % self.table_name
 
+
+
+class Mirror(object):
+    """ A copy of a webstore table in a local SQLite file, created with
+    ``Table.mirror``. Reads run against the local copy, and `sync` 
+    fetches the rows that were added or changed on the server since
+    the last sync::
+
+      mirror = table.mirror('weather.db', watermark='updated')
+      rows = list(mirror.traverse(place='Berlin'))
+      mirror.sync()
+
+    Rows are identified by the `key` column and found by the 
+    `watermark` column, which must grow whenever a row is added or 
+    changed (e.g. the implicit row id ``__id__`` for tables that are 
+    only appended to, or a modification time). Rows deleted on the
+    server are only removed by a full sync. """
+
+    STATE_TABLE = '_webstore_mirror'
+
+    def __init__(self, table, path, watermark='__id__', key='__id__',
+                 step=10000):
+        """ Open or create a mirror of `table` in the file at `path`. 
+        Usually created via ``Table.mirror``.
+
+        :Parameters:
+            - `table`: the ``Table`` to mirror.
+            - `path`: the SQLite file to store the copy in.
+            - `watermark`: a column whose value grows when a row is added
+              or changed.
+            - `key`: a unique column identifying each row.
+            - `step`: the number of rows fetched with each request.
+        """
+        import sqlite3
+        self.table = table
+        self.path = path
+        self.watermark = watermark
+        self.key = key
+        self.step = step
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = Lock()
+        self.connection.execute('CREATE TABLE IF NOT EXISTS %s ('
+            'table_name TEXT PRIMARY KEY, last_value, last_key, '
+            'synced REAL)' % _quote_identifier(self.STATE_TABLE))
+        self._columns = self._local_columns()
+
+    def _local_columns(self):
+        cur = self.connection.execute('PRAGMA table_info(%s)' %
+            _quote_identifier(self.table.table_name))
+        return set(r[1] for r in cur)
+
+    def _add_columns(self, names):
+        """ Create the local table or add missing columns to it. """
+        table = _quote_identifier(self.table.table_name)
+        if not len(self._columns):
+            column = _quote_identifier(self.key)
+            if self.key == '__id__':
+                column += ' INTEGER'
+            self.connection.execute('CREATE TABLE %s (%s PRIMARY KEY)' % (
+                                    table, column))
+            self._columns.add(self.key)
+        for name in names:
+            if name not in self._columns:
+                self.connection.execute('ALTER TABLE %s ADD COLUMN %s' % (
+                                        table, _quote_identifier(name)))
+                self._columns.add(name)
+
+    def _state(self):
+        cur = self.connection.execute('SELECT last_value, last_key FROM %s '
+            'WHERE table_name = ?' % _quote_identifier(self.STATE_TABLE),
+            [self.table.table_name])
+        return cur.fetchone() or (None, None)
+
+    def _remote_page(self, last_value, last_key):
+        """ Fetch the next rows in order of (watermark, key). """
+        watermark = _quote_identifier(self.watermark)
+        key = _quote_identifier(self.key)
+        sql = 'SELECT * FROM ' + _quote_identifier(self.table.table_name)
+        params = []
+        if last_value is not None:
+            sql += ' WHERE %s > ? OR (%s = ? AND %s > ?)' % (watermark,
+                                                         watermark, key)
+            params = [last_value, last_value, last_key]
+        if self.watermark == self.key:
+            sql += ' ORDER BY %s ASC' % key
+        else:
+            sql += ' ORDER BY %s ASC, %s ASC' % (watermark, key)
+        sql += ' LIMIT %d' % self.step
+        return self.table._retrying(self.table.database.query, sql,
+                                    params)['data']
+
+    def sync(self, full=False):
+        """ Fetch the rows added or changed since the last sync and 
+        store them locally. With `full`, the local copy is discarded and
+        the whole table is fetched again, which also removes rows that
+        have been deleted on the server. Returns the number of rows
+        fetched. """
+        with self._lock:
+            if full:
+                self.connection.execute('DROP TABLE IF EXISTS %s' %
+                    _quote_identifier(self.table.table_name))
+                self.connection.execute('DELETE FROM %s WHERE table_name '
+                    '= ?' % _quote_identifier(self.STATE_TABLE),
+                    [self.table.table_name])
+                self.connection.commit()
+                self._columns = set()
+            last_value, last_key = self._state()
+            count = 0
+            while True:
+                rows = self._remote_page(last_value, last_key)
+                if not len(rows):
+                    break
+                names = set()
+                for row in rows:
+                    names.update(row.keys())
+                self._add_columns(sorted(names))
+                names = list(names)
+                self.connection.executemany('INSERT OR REPLACE INTO %s '
+                    '(%s) VALUES (%s)' % (
+                        _quote_identifier(self.table.table_name),
+                        ', '.join(map(_quote_identifier, names)),
+                        ', '.join('?' * len(names))),
+                    [[row.get(n) for n in names] for row in rows])
+                last_value = rows[-1][self.watermark]
+                last_key = rows[-1][self.key]
+                self.connection.execute('INSERT OR REPLACE INTO %s VALUES '
+                    '(?, ?, ?, ?)' % _quote_identifier(self.STATE_TABLE),
+                    [self.table.table_name, last_value, last_key, time()])
+                self.connection.commit()
+                count += len(rows)
+                if len(rows) < self.step:
+                    break
+            return count
+
+    def query(self, query, params=None):
+        """ Run an SQL query against the local copy, returning a list of
+        rows as dictionaries. """
+        with self._lock:
+            cur = self.connection.execute(query, params or [])
+            if cur.description is None:
+                self.connection.commit()
+                return []
+            keys = [d[0] for d in cur.description]
+            return [dict(zip(keys, r)) for r in cur.fetchall()]
+
+    def traverse(self, _sort=[], _limit=None, _offset=0, _where=None,
+                 **kwargs):
+        """ Iterate over the local copy. The parameters are those of 
+        ``Table.traverse``, keyword arguments filter by column value. """
+        if not len(self._columns):
+            return iter([])
+        sql = 'SELECT * FROM ' + _quote_identifier(self.table.table_name)
+        where, params = _filter_clause(kwargs.items(), _where)
+        if len(where):
+            sql += ' WHERE ' + ' AND '.join(where)
+        if len(_sort):
+            sql += ' ORDER BY ' + ', '.join('%s %s' % (_quote_identifier(c),
+                'DESC' if d == DESCENDING else 'ASC') for c, d in _sort)
+        if _limit is not None or _offset:
+            sql += ' LIMIT %d OFFSET %d' % (-1 if _limit is None else _limit,
+                                            _offset)
+        return iter(self.query(sql, params))
+
+    def __iter__(self):
+        return self.traverse()
+
+    def __len__(self):
+        if not len(self._columns):
+            return 0
+        return self.query('SELECT COUNT(*) AS n FROM %s' %
+                          _quote_identifier(self.table.table_name))[0]['n']
+
+    def close(self):
+        self.connection.close()
+
+    def __repr__(self):
+        return "<Mirror(%s -> %s)>" % (self.table.table_name, self.path)
+
+
+class _Descending(object):
+    """ Wraps a sort key value to invert its order. """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _sort_key(sort):
+    """ Build a key function ordering rows like the server would for
+    `sort`, a list of (column, direction) tuples. """
+    def _key(row):
+        return tuple(_Descending(row[c]) if d == DESCENDING else row[c]
+                     for c, d in sort)
+    return _key
+
+
+def _merge(streams, key):
+    """ Merge the already sorted `streams` into one sorted stream,
+    keeping only the next row of each on a heap. Rows with equal keys
+    are yielded in the order of the streams. """
+    heap = []
+    for index, stream in enumerate(streams):
+        for row in stream:
+            heap.append((key(row), index, row, stream))
+            break
+    heapq.heapify(heap)
+    while heap:
+        k, index, row, stream = heap[0]
+        yield row
+        for row in stream:
+            heapq.heapreplace(heap, (key(row), index, row, stream))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+class ShardedTable(object):
+    """ A table that is split across several databases, e.g. one per
+    user. Reads run against all shards at once and are combined into a
+    single stream, so that they take about as long as the slowest shard
+    rather than as long as all of them together::
+
+      shards = ShardedTable([db1, db2, db3], 'weather')
+      for row in shards.traverse(_sort=[('temp', 'desc')], _limit=10):
+          ...
+    """
+
+    def __init__(self, handles, table_name=None):
+        """ Combine a list of tables into one.
+
+        :Parameters:
+            - `handles`: a list of ``Table`` handles, or of ``Database``
+              handles if `table_name` is given.
+            - `table_name`: the name of the table in each database.
+        """
+        if table_name is not None:
+            handles = [h[table_name] if isinstance(h, Database) else h
+                       for h in handles]
+        self.tables = list(handles)
+
+    def _produce(self, rows, queue, stop, batch_size):
+        """ Read `rows` into `queue` in batches until they run out or
+        `stop` is set. The end is marked with ``None``, a failure with
+        the exception info. """
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    if not _put(batch):
+                        return
+                    batch = []
+            if len(batch) and not _put(batch):
+                return
+            _put(None)
+        except Exception:
+            _put(sys.exc_info())
+        finally:
+            rows.close()
+
+    def _stream(self, queue, producers=1):
+        """ Yield the rows that `producers` put into `queue`. """
+        while producers:
+            batch = queue.get()
+            if batch is None:
+                producers -= 1
+                continue
+            if isinstance(batch, tuple):
+                raise batch[0], batch[1], batch[2]
+            for row in batch:
+                yield row
+
+    def traverse(self, _sort=[], _limit=None, _offset=0, _step=1000,
+                 _buffer=4, **kwargs):
+        """ Traverse all shards at once, with one thread per shard. With
+        `_sort`, each shard sorts its rows and the streams are merged 
+        into one sorted stream. Otherwise, rows are yielded in the order
+        in which they arrive.
+
+        :Parameters:
+            - `_sort`, `_step` and other keyword arguments: see 
+              ``Table.traverse``, they are passed on to every shard.
+            - `_limit`: the maximum number of rows to yield. Each shard
+              is asked for no more than `_limit` plus `_offset` rows.
+            - `_offset`: the number of rows to skip in the combined
+              stream.
+            - `_buffer`: the number of pages each shard may read ahead of
+              the rows that have been yielded.
+        """
+        if _limit is not None:
+            kwargs['_limit'] = _limit + _offset
+        stop = Event()
+        pool = _WorkerPool(len(self.tables))
+        # merging needs a queue per shard, otherwise all shards share one.
+        if _sort:
+            queues = [Queue(_buffer) for t in self.tables]
+        else:
+            queues = [Queue(_buffer * len(self.tables))] * len(self.tables)
+        for table, queue in zip(self.tables, queues):
+            rows = table.traverse(_step=_step, _sort=_sort, **kwargs)
+            pool.submit(self._produce, rows, queue, stop, _step)
+        try:
+            if _sort:
+                rows = _merge([self._stream(q) for q in queues],
+                              _sort_key(_sort))
+            elif len(queues):
+                rows = self._stream(queues[0], len(queues))
+            else:
+                rows = []
+            count = 0
+            for row in rows:
+                count += 1
+                if count <= _offset:
+                    continue
+                yield row
+                if _limit is not None and count - _offset >= _limit:
+                    break
+        finally:
+            stop.set()
+            pool.shutdown()
+
+    def count(self, **kwargs):
+        """ Count the rows in all shards, see ``Table.count``. """
+        pool = _WorkerPool(len(self.tables))
+        try:
+            futures = [pool.submit(t.count, **kwargs) for t in self.tables]
+            return sum(f.result() for f in futures)
+        finally:
+            pool.shutdown()
+
+    def __iter__(self):
+        return self.traverse()
+
+    def __repr__(self):
+        return "<ShardedTable(%s shards)>" % len(self.tables)
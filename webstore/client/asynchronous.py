@@ -0,0 +1,383 @@
+""" A non-blocking variant of the webstore client. Requests are run on
+non-blocking sockets driven by an ``asyncore`` loop, so a single thread
+can keep many requests in flight at once. Every call returns an
+``AsyncResult`` instead of blocking::
+
+    database = AsyncDatabase('webstore.myserver.org', 'me', 'testdb')
+    results = [database.query(q) for q in queries]
+    database.run()
+    rows = [r.result() for r in results]
+"""
+import sys
+import socket
+import asyncore
+from collections import defaultdict
+from urllib import urlencode
+
+from webstore.client import _Base, _traverse_query, _page_windows, \
+    _page_path, WebstoreClientException, SEP, CHUNK_SIZE
+
+
+class AsyncResult(object):
+    """ The eventual result of a request. Callbacks can be attached
+    with `then`, or `result` can be called to run the loop until the
+    request has finished. """
+
+    def __init__(self, map):
+        self._map = map
+        self._done = False
+        self._value = None
+        self._error = None
+        self._callbacks = []
+
+    def _resolve(self, value):
+        if isinstance(value, AsyncResult):
+            value._add(self._resolve, self._fail)
+            return
+        self._done, self._value = True, value
+        self._fire()
+
+    def _fail(self, exc_info):
+        self._done, self._error = True, exc_info
+        self._fire()
+
+    def _fire(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for callback, errback in callbacks:
+            if self._error is None:
+                callback(self._value)
+            else:
+                errback(self._error)
+
+    def _add(self, callback, errback):
+        self._callbacks.append((callback, errback))
+        if self._done:
+            self._fire()
+
+    def then(self, callback, errback=None):
+        """ Return a new result for `callback` applied to the value of
+        this one. If given, `errback` is called with the exception
+        instead when the request fails; it may return a value to
+        recover or raise. """
+        result = AsyncResult(self._map)
+
+        def _call(func, arg):
+            try:
+                result._resolve(func(arg))
+            except Exception:
+                result._fail(sys.exc_info())
+
+        def _callback(value):
+            _call(callback, value)
+
+        def _errback(exc_info):
+            if errback is None:
+                return result._fail(exc_info)
+            _call(errback, exc_info[1])
+        self._add(_callback, _errback)
+        return result
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """ Run the loop until this result is available, then return
+        it or raise the exception the request failed with. """
+        while not self._done:
+            if not len(self._map):
+                raise RuntimeError("No request pending for this result.")
+            asyncore.loop(timeout=1, use_poll=True, map=self._map, count=1)
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._value
+
+    @classmethod
+    def gather(cls, map, results):
+        """ Combine several results into one for the list of their
+        values, in the given order. """
+        combined = cls(map)
+        values = [None] * len(results)
+        pending = [len(results)]
+
+        def _collect(index):
+            def _callback(value):
+                values[index] = value
+                pending[0] -= 1
+                if not pending[0]:
+                    combined._resolve(values)
+            return _callback
+
+        def _errback(exc_info):
+            if not combined._done:
+                combined._fail(exc_info)
+        for index, result in enumerate(results):
+            result._add(_collect(index), _errback)
+        if not len(results):
+            combined._resolve(values)
+        return combined
+
+
+class _AsyncResponse(object):
+    """ A complete HTTP response, mimicking the parts of
+    ``HTTPResponse`` that response decoding relies on. """
+
+    def __init__(self, raw):
+        head, sep, body = raw.partition('\r\n\r\n')
+        if not sep:
+            raise socket.error("Incomplete response from server.")
+        lines = head.split('\r\n')
+        status = lines[0].split(' ', 2)
+        self.status = int(status[1])
+        self.reason = status[2] if len(status) > 2 else ''
+        self.msg = dict((k.strip().lower(), v.strip()) for k, v in
+                        (l.split(':', 1) for l in lines[1:] if ':' in l))
+        if self.getheader('transfer-encoding', '').lower() == 'chunked':
+            body = self._dechunk(body)
+        elif self.getheader('content-length') is not None:
+            body = body[:int(self.getheader('content-length'))]
+        self._body = body
+
+    def _dechunk(self, body):
+        parts = []
+        while body:
+            size, _, body = body.partition('\r\n')
+            size = int(size.split(';')[0], 16)
+            if not size:
+                break
+            parts.append(body[:size])
+            body = body[size + 2:]
+        return ''.join(parts)
+
+    def getheader(self, name, default=None):
+        return self.msg.get(name.lower(), default)
+
+    def read(self, amt=None):
+        body, self._body = self._body, ''
+        return body
+
+    def close(self):
+        pass
+
+
+class _Exchange(asyncore.dispatcher):
+    """ A single request on its own non-blocking connection. The
+    response is read until the server closes the connection. """
+
+    def __init__(self, server, port, request, result, map):
+        asyncore.dispatcher.__init__(self, map=map)
+        self._out = request
+        self._in = []
+        self._result = result
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((server, port))
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self._out)
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        self._in.append(self.recv(CHUNK_SIZE))
+
+    def handle_close(self):
+        self.close()
+        try:
+            response = _AsyncResponse(''.join(self._in))
+        except Exception:
+            return self._result._fail(sys.exc_info())
+        self._result._resolve(response)
+
+    def handle_error(self):
+        self.close()
+        self._result._fail(sys.exc_info())
+
+
+class _AsyncBase(_Base):
+    """ Common base for ``AsyncDatabase`` and ``AsyncTable``: runs
+    requests on the loop, using the URL building and response decoding
+    of the blocking client. """
+
+    def _raw_request(self, method, path, data=None, headers={}):
+        path, data, headers = self._prepare(path, data, headers)
+        headers['Host'] = '%s:%s' % (self.server, self.port)
+        headers['Connection'] = 'close'
+        lines = ['%s %s HTTP/1.1' % (method, path)]
+        lines.extend('%s: %s' % h for h in headers.items())
+        request = '\r\n'.join(lines) + '\r\n\r\n' + (data or '')
+        result = AsyncResult(self.map)
+        _Exchange(self.server, self.port, request, result, self.map)
+        return result
+
+    def _request(self, method, path, data=None, headers={}):
+        data, headers = self._encode(data, headers)
+        response = self._raw_request(method, path, data, headers)
+        return response.then(self._decode)
+
+    def _success(self, exc):
+        """ Errback for requests that report success as an error. """
+        if not isinstance(exc, WebstoreClientException) or \
+                exc.state != 'success':
+            raise exc
+
+    def run(self):
+        """ Run the loop until all pending requests have finished. """
+        while len(self.map):
+            asyncore.loop(timeout=1, use_poll=True, map=self.map, count=1)
+
+
+class AsyncDatabase(_AsyncBase):
+    """ A non-blocking handle for a webstore database. All requests
+    return an ``AsyncResult``. """
+
+    def __init__(self, server, database_user, database_name,
+            port=None, http_user=None, http_password=None,
+            http_apikey=None, attach=[], map=None,
+            compress_threshold=None):
+        """ Create a new non-blocking database handle. The parameters
+        are those of ``Database``, with the addition of:
+
+        :Parameters:
+            - `map`: the ``asyncore`` socket map to run requests on,
+              a new one is created if none is given.
+        """
+        self.database_user = database_user
+        self.database_name = database_name
+        self.http_user = http_user
+        self.http_password = http_password
+        self.http_apikey = http_apikey
+        self.attach = attach
+        self.map = map if map is not None else {}
+        assert not '/' in server, "Server hostname most not contain '/'!"
+        base_path = '/' + database_user + '/' + database_name
+        super(AsyncDatabase, self).__init__(server, port, base_path,
+                http_user, http_password, http_apikey,
+                compress_threshold=compress_threshold)
+
+    def query(self, query, params=None):
+        """ Run a raw SQL query against the webstore. See
+        ``Database.query``. """
+        payload = {
+            "query": query,
+            "attach": self.attach
+            }
+        if params is not None:
+            payload['params'] = params
+        return self._request("PUT", '', data=payload)
+
+    def tables(self):
+        """ Get a list of the tables defined in this database. """
+        return self._request("GET", '').then(
+            lambda response: [r.get('name') for r in response['data']])
+
+    def __getitem__(self, table_name):
+        """ Get a non-blocking handle for a table in this database. """
+        return AsyncTable(self, table_name)
+
+    def __repr__(self):
+        return "<AsyncDatabase(%s / %s)>" % (self.database_user,
+                                             self.database_name)
+
+
+class AsyncTable(_AsyncBase):
+    """ A non-blocking handle for a table, usually created via
+    async_database[table_name]. All requests return an
+    ``AsyncResult``. """
+
+    def __init__(self, database, table_name):
+        self.database = database
+        self.table_name = table_name
+        self.unique_columns = []
+        self.map = database.map
+        self._buffer = defaultdict(list)
+        super(AsyncTable, self).__init__(database.server, database.port,
+                database.base_path + '/' + table_name,
+                database.http_user, database.http_password,
+                database.http_apikey,
+                compress_threshold=database.compress_threshold)
+
+    def traverse(self, callback, _step=1000, _sort=[], _limit=None,
+                 _offset=0, **kwargs):
+        """ Traverse the table, calling `callback` with each row in
+        order. Pages are requested one after another. The result is
+        the number of rows that have been traversed. For the
+        parameters, see ``Table.traverse``. """
+        query = _traverse_query(_sort, kwargs)
+        windows = _page_windows(_step, _limit, _offset)
+        result = AsyncResult(self.map)
+        state = {'count': 0}
+
+        # each page starts the request for the next one and the last
+        # page resolves the outer result directly, rather than
+        # resolving to the next page's result, so that the chain of
+        # callbacks does not grow with the number of pages.
+        def _next_page():
+            for offset, limit in windows:
+                page = self._request("GET", _page_path(query, offset, limit))
+                page._add(lambda response: _page(response, limit),
+                          result._fail)
+                return
+            result._resolve(state['count'])
+
+        def _page(response, limit):
+            try:
+                for row in response['data']:
+                    callback(row)
+                state['count'] += len(response['data'])
+                if len(response['data']) < limit:
+                    return result._resolve(state['count'])
+                _next_page()
+            except Exception:
+                result._fail(sys.exc_info())
+        _next_page()
+        return result
+
+    def writerows(self, rows, unique_columns=None, bufferlen=None):
+        """ Write a set of rows to the table. See ``Table.writerows``. """
+        if bufferlen is not None:
+            key = SEP.join(unique_columns or [])
+            self._buffer[key].extend(rows)
+            if len(self._buffer[key]) >= bufferlen:
+                rows, self._buffer[key] = self._buffer[key], list()
+                return self.writerows(rows, unique_columns=unique_columns)
+            result = AsyncResult(self.map)
+            result._resolve({'state': 'buffered'})
+            return result
+        unique_columns = unique_columns or self.unique_columns
+        query = '?' + urlencode([('unique', u) for u in unique_columns])
+        return self._request("POST", query, rows).then(lambda r: r,
+                                                        self._success)
+
+    def writerow(self, row, unique_columns=None, bufferlen=None):
+        """ Write a single row. See ``Table.writerows``. """
+        return self.writerows([row], unique_columns=unique_columns,
+                              bufferlen=bufferlen)
+
+    def flush(self):
+        """ Flush write buffer. """
+        results = []
+        for key, rows in self._buffer.items():
+            unique_columns = key.split(SEP) if key else []
+            results.append(self.writerows(rows,
+                                          unique_columns=unique_columns))
+            self._buffer[key] = []
+        return AsyncResult.gather(self.map, results)
+
+    def schema(self, column_name):
+        """ Get information about the table layout. """
+        return self._request('GET', self.table_name + '/schema')
+
+    def distinct(self, column_name):
+        """ Get all distinct values for a column. """
+        return self._request('GET', self.table_name + '/distinct/' + column_name)
+
+    def delete(self):
+        """ Delete the table entirely. """
+        return self._request("DELETE", '').then(lambda r: r, self._success)
+
+    def __repr__(self):
+        return "<AsyncTable(%s)>" % self.table_name